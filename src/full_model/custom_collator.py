@@ -1,6 +1,22 @@
 import torch
 
 
+def image_targets_to_device(batch, device):
+    """
+    Copies the boxes and labels of all images in the batch to the device with a single copy each
+    (instead of 2 copies per image), and returns the list of dicts image_targets (containing the keys "boxes" and "labels" for each image),
+    where the boxes and labels of each image are views of the copied tensors.
+    """
+    boxes = batch["image_targets_boxes"].to(device, non_blocking=True)
+    labels = batch["image_targets_labels"].to(device, non_blocking=True)
+    num_boxes_per_image = batch["num_boxes_per_image"]
+
+    return [
+        {"boxes": boxes_img, "labels": labels_img}
+        for boxes_img, labels_img in zip(torch.split(boxes, num_boxes_per_image), torch.split(labels, num_boxes_per_image))
+    ]
+
+
 class CustomCollator:
     def __init__(self, tokenizer, is_val_or_test, pretrain_without_lm_model):
         self.tokenizer = tokenizer
@@ -30,8 +46,10 @@ class CustomCollator:
         image_size = batch[0]["image"].size()
         images_batch = torch.empty(size=(len(batch), *image_size))
 
-        # create an empty list image_targets that will store dicts containing the bbox_coordinates and bbox_labels
-        image_targets = []
+        # create empty lists that will store the bbox_coordinates and bbox_labels of each image
+        # (they are concatenated after the loop, such that they can be copied to the device at once, see image_targets_to_device)
+        boxes_batch = []
+        labels_batch = []
 
         # allocate an empty tensor region_has_sentence that will store all bbox_phrase_exists tensors of the batch
         bbox_phrase_exists_size = batch[0]["bbox_phrase_exists"].size()  # should be torch.Size([29])
@@ -53,10 +71,9 @@ class CustomCollator:
             # remove image tensors from batch and store them in dedicated images_batch tensor
             images_batch[i] = sample_dict.pop("image")
 
-            # remove bbox_coordinates and bbox_labels and store them in list image_targets
-            boxes = sample_dict.pop("bbox_coordinates")
-            labels = sample_dict.pop("bbox_labels")
-            image_targets.append({"boxes": boxes, "labels": labels})
+            # remove bbox_coordinates and bbox_labels and store them in lists boxes_batch and labels_batch
+            boxes_batch.append(sample_dict.pop("bbox_coordinates"))
+            labels_batch.append(sample_dict.pop("bbox_labels"))
 
             # remove bbox_phrase_exists tensors from batch and store them in dedicated region_has_sentence tensor
             region_has_sentence[i] = sample_dict.pop("bbox_phrase_exists")
@@ -91,9 +108,20 @@ class CustomCollator:
             # treat dict_with_ii_and_am as the batch variable now (since it is a dict, and we can use it to store all the other keys as well)
             batch = dict_with_ii_and_am
 
+        # the boxes and labels of all images are concatenated into tensors of shape [num_boxes_in_batch x 4] and [num_boxes_in_batch]
+        # (the number of boxes per image is usually 29, but is kept track of to be able to split the tensors up again)
+        num_boxes_per_image = [boxes.size(0) for boxes in boxes_batch]
+        image_targets_boxes = torch.cat(boxes_batch, dim=0)
+        image_targets_labels = torch.cat(labels_batch, dim=0)
+
+        # note: the list of dicts image_targets with the boxes and labels of each image is only created on the device side (see image_targets_to_device),
+        # since a DataLoader with pin_memory=True would otherwise pin a separate copy of every per-image view
+
         # add the remaining keys and values to the batch dict
         batch["images"] = images_batch
-        batch["image_targets"] = image_targets
+        batch["image_targets_boxes"] = image_targets_boxes
+        batch["image_targets_labels"] = image_targets_labels
+        batch["num_boxes_per_image"] = num_boxes_per_image
         batch["region_has_sentence"] = region_has_sentence
         batch["region_is_abnormal"] = region_is_abnormal
 
@@ -2,6 +2,7 @@ import gzip
 import os
 import pathlib
 import pickle
+import statistics
 
 import numpy as np
 from pycocoevalcap.cider.cider_scorer import CiderScorer
@@ -31,5 +32,7 @@ class CustomCiderScorer(CiderScorer):
         return cider_df
 
     def compute_score(self):
+        # score is a list of floats (1 CIDEr score per report), so the mean is computed directly on the list
+        # instead of building a second numpy array just for the mean
         score = self.compute_cider()
-        return np.mean(np.array(score)), np.array(score)
+        return statistics.fmean(score), np.array(score)
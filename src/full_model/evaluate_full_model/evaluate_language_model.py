@@ -10,6 +10,8 @@ evaluate_language_model returns language_model_scores which include:
         - generated sentences with gt = normal region (i.e. the region was considered normal by the radiologist)
         - generated sentences with gt = abnormal region (i.e. the region was considered abnormal by the radiologist)
 
+    - corpus-level BLEU 1-4 over all generated sentences (computed directly on the token ids, logged as bleu_{n}_token_ids, see tensor_bleu)
+
     - BLEU 1-4, METEOR, ROUGE-L, CIDEr-D for all generated reports
     - Clinical efficacy metrics for all generated reports:
         - micro-averaged over 5 observations
@@ -25,13 +27,19 @@ It also calls subfunctions which:
     as well as the generated sentences (if they exist) and reference sentences for every region
 """
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 import csv
+import functools
+import hashlib
 import io
 import os
 import re
 import tempfile
+import textwrap
 
-import evaluate
+from bert_score import BERTScorer
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
@@ -41,7 +49,10 @@ from pycocoevalcap.rouge.rouge import Rouge
 import spacy
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support
 import torch
+import torch.distributed as dist
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 from src.CheXbert.src.constants import CONDITIONS
@@ -59,7 +70,8 @@ from src.full_model.run_configurations import (
     NUM_IMAGES_TO_PLOT,
     BERTSCORE_SIMILARITY_THRESHOLD,
 )
-from src.path_datasets_and_weights import path_chexbert_weights
+from src.path_datasets_and_weights import path_chexbert_weights, path_generation_cache
+from src.utils import eval_autocast_dtype, pin_for_non_blocking_copy
 
 device = torch.device(
     "cuda"
@@ -68,6 +80,49 @@ device = torch.device(
 )
 
 
+def is_dist_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    return dist.get_world_size() if is_dist_initialized() else 1
+
+
+def is_main_process():
+    """
+    Only the main process (rank 0) writes to tensorboard and to files if the evaluation is run on multiple gpus.
+    Without torch.distributed, the (single) process is always the main process.
+    """
+    return not is_dist_initialized() or dist.get_rank() == 0
+
+
+# renders the figures of plot_detections_and_sentences_to_tensorboard in the background, such that the generation is not blocked by plotting
+# (with a single worker, since matplotlib is not thread-safe, i.e. figures must never be drawn concurrently)
+plot_executor = ThreadPoolExecutor(max_workers=1)
+
+# the single worker thread of plot_executor reuses a single figure and axes (see get_plot_figure_and_axes),
+# since creating a new figure for every region set is expensive
+plot_fig = None
+plot_ax = None
+
+# used in plot_detections_and_sentences_to_tensorboard:
+# plot 6 regions at a time, as to not overload the image with boxes (except for region_set_5, which has 5 regions)
+# the region_sets were chosen as to minimize overlap between the contained regions (i.e. better visibility)
+REGION_SETS = [
+    ["right lung", "right costophrenic angle", "left lung", "left costophrenic angle", "cardiac silhouette", "spine"],
+    ["right upper lung zone", "right mid lung zone", "right lower lung zone", "left upper lung zone", "left mid lung zone", "left lower lung zone"],
+    ["right hilar structures", "right apical zone", "left hilar structures", "left apical zone", "right hemidiaphragm", "left hemidiaphragm"],
+    ["trachea", "right clavicle", "left clavicle", "aortic arch", "abdomen", "right atrium"],
+    ["mediastinum", "svc", "cavoatrial junction", "carina", "upper mediastinum"],
+]
+
+# the colors of the bboxes of a region_set (region_set_5 only uses the first 5 colors)
+REGION_COLORS = ["b", "g", "r", "c", "m", "y"]
+
+# the region indices of each region_set, precomputed such that the boxes of a region_set can be selected with a single (fancy) index operation
+REGION_INDICES = [np.array([ANATOMICAL_REGIONS[region] for region in region_set], dtype=np.int64) for region_set in REGION_SETS]
+
+
 def compute_NLG_scores(nlg_metrics: list[str], gen_sents_or_reports: list[str], ref_sents_or_reports: list[str]) -> dict[str, float]:
     def convert_for_pycoco_scorer(sents_or_reports: list[str]):
         """
@@ -126,6 +181,105 @@ def compute_NLG_scores(nlg_metrics: list[str], gen_sents_or_reports: list[str],
     return nlg_scores
 
 
+def tensor_bleu(pred_ids: torch.LongTensor, ref_ids: torch.LongTensor, special_token_id: int, max_order: int = 4) -> list[float]:
+    """
+    Computes the (corpus-level) BLEU 1 to max_order scores directly on token ids, without decoding them into strings first.
+
+    Args:
+        pred_ids (Tensor[int]): of shape [num_sentences x max_pred_seq_len], generated token ids (padded with special_token_id)
+        ref_ids (Tensor[int]): of shape [num_sentences x max_ref_seq_len], reference token ids (padded with special_token_id)
+        special_token_id (int): id of the bos/eos/pad token (all the same for the GPT2 tokenizer), these tokens are ignored
+        max_order (int): the highest n-gram order
+
+    Returns:
+        bleu_scores (List[float]): of len max_order, with bleu_scores[n-1] being the cumulative BLEU-n score
+
+    The n-grams of all sentences are extracted with unfold, and mapped to small integer ids with torch.unique (i.e. a compact
+    dictionary of only the n-grams that actually occur in the sentences). The n-gram counts for each sentence are then computed sparsely
+    with torch.unique over the keys (sentence index * num_unique_ngrams + ngram id), such that the clipped counts can be computed for all
+    sentences at once, with memory that only grows linearly with the number of n-grams (instead of with num_sentences * num_unique_ngrams).
+
+    Note that since the scores are computed on the token ids (of the GPT2 tokenizer), they are not directly comparable to BLEU scores
+    computed on whitespace-tokenized strings (e.g. by pycocoevalcap).
+    """
+    def extract_ngrams(ids, valid_tokens, n):
+        """
+        Returns all n-grams of shape [num_ngrams x n] that only consist of valid tokens,
+        and a tensor of shape [num_ngrams] that specifies the sentence (i.e. row) each n-gram belongs to.
+        """
+        if ids.size(1) < n:
+            return ids.new_empty((0, n)), ids.new_empty((0,))
+
+        # ngrams is of shape [num_sentences x (seq_len - n + 1) x n]
+        ngrams = ids.unfold(1, n, 1)
+        valid_ngrams = valid_tokens.unfold(1, n, 1).all(dim=-1)
+
+        sentence_indices = torch.arange(ids.size(0), device=ids.device).unsqueeze(1).expand_as(valid_ngrams)
+
+        return ngrams[valid_ngrams], sentence_indices[valid_ngrams]
+
+    valid_pred_tokens = pred_ids != special_token_id
+    valid_ref_tokens = ref_ids != special_token_id
+
+    pred_length = valid_pred_tokens.sum().item()
+    ref_length = valid_ref_tokens.sum().item()
+
+    clipped_matches = []
+    total_pred_ngrams = []
+
+    for n in range(1, max_order + 1):
+        pred_ngrams, pred_sentence_indices = extract_ngrams(pred_ids, valid_pred_tokens, n)
+        ref_ngrams, ref_sentence_indices = extract_ngrams(ref_ids, valid_ref_tokens, n)
+
+        num_pred_ngrams = pred_ngrams.size(0)
+
+        if num_pred_ngrams == 0:
+            clipped_matches.append(0)
+            total_pred_ngrams.append(0)
+            continue
+
+        # map every n-gram to an integer id (only n-grams that occur in the pred and ref sentences are part of the dictionary)
+        unique_ngrams, ngram_ids = torch.unique(torch.cat([pred_ngrams, ref_ngrams], dim=0), dim=0, return_inverse=True)
+        num_unique_ngrams = unique_ngrams.size(0)
+
+        # count the n-grams for every sentence (by offsetting the ngram ids with the sentence index)
+        # only the (sentence, n-gram) keys that actually occur are counted, the unique keys are returned in sorted order
+        pred_keys, pred_counts = torch.unique(pred_sentence_indices * num_unique_ngrams + ngram_ids[:num_pred_ngrams], return_counts=True)
+        ref_keys, ref_counts = torch.unique(ref_sentence_indices * num_unique_ngrams + ngram_ids[num_pred_ngrams:], return_counts=True)
+
+        if ref_keys.size(0) == 0:
+            clipped_matches.append(0)
+            total_pred_ngrams.append(num_pred_ngrams)
+            continue
+
+        # look up the ref count of every pred key in the sorted ref keys (pred keys that don't occur in the ref sentence get a ref count of 0)
+        positions = torch.searchsorted(ref_keys, pred_keys).clamp(max=ref_keys.size(0) - 1)
+        ref_counts_of_pred_keys = torch.where(ref_keys[positions] == pred_keys, ref_counts[positions], torch.zeros_like(pred_counts))
+
+        # clip the pred counts by the ref counts of the same sentence
+        clipped_matches.append(torch.minimum(pred_counts, ref_counts_of_pred_keys).sum().item())
+        total_pred_ngrams.append(num_pred_ngrams)
+
+    # brevity penalty
+    if pred_length == 0:
+        return [0.0] * max_order
+
+    brevity_penalty = 1.0 if pred_length > ref_length else float(np.exp(1 - ref_length / pred_length))
+
+    bleu_scores = []
+    log_precision_sum = 0.0
+    for n in range(max_order):
+        if clipped_matches[n] == 0:
+            # all higher order BLEU scores will be 0 as well
+            bleu_scores.extend([0.0] * (max_order - n))
+            break
+
+        log_precision_sum += np.log(clipped_matches[n] / total_pred_ngrams[n])
+        bleu_scores.append(brevity_penalty * float(np.exp(log_precision_sum / (n + 1))))
+
+    return bleu_scores
+
+
 def compute_clinical_efficacy_scores(language_model_scores: dict, gen_reports: list[str], ref_reports: list[str]):
     """
     This function computes:
@@ -323,7 +477,12 @@ def compute_clinical_efficacy_scores(language_model_scores: dict, gen_reports: l
     compute_example_based_CE_scores(preds_gen_reports, preds_ref_reports)
 
 
-def compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports):
+def compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports, special_token_id=None):
+    """
+    If special_token_id is specified, then gen_and_ref_sentences also holds the token ids of the generated and reference sentences
+    under the keys "generated_sentences_ids" and "reference_sentences_ids", which are used to compute the corpus-level BLEU scores
+on the token ids of all sentences (i.e. one BLEU-n score over all generated sentences, see tensor_bleu).
+    """
 
     def compute_sentence_level_scores():
         def remove_gen_sents_corresponding_to_empty_ref_sents(gen_sents, ref_sents):
@@ -399,6 +558,26 @@ def compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports):
 
             language_model_scores["all"]["meteor_ratio"] = numerator_meteor_score / denominator_meteor_score
 
+        def compute_corpus_level_token_id_bleu_scores():
+            """
+            Corpus-level BLEU 1-4 over all generated sentences, computed directly on the token ids (see tensor_bleu).
+            The token id tensors of the different batches have different seq_lens, so they are padded with the special token first.
+            """
+            def pad_and_concat(list_of_ids):
+                max_seq_len = max(ids.size(1) for ids in list_of_ids)
+                return torch.cat([F.pad(ids.to(device), (0, max_seq_len - ids.size(1)), value=special_token_id) for ids in list_of_ids], dim=0)
+
+            gen_sents_ids = pad_and_concat(gen_and_ref_sentences["generated_sentences_ids"])
+            ref_sents_ids = pad_and_concat(gen_and_ref_sentences["reference_sentences_ids"])
+
+            # discard generated sentences whose corresponding reference sentence is empty (i.e. only consists of special tokens)
+            non_empty_ref_sents = (ref_sents_ids != special_token_id).any(dim=1)
+
+            bleu_scores = tensor_bleu(gen_sents_ids[non_empty_ref_sents], ref_sents_ids[non_empty_ref_sents], special_token_id, max_order=4)
+
+            for i, score in enumerate(bleu_scores, start=1):
+                language_model_scores["all"][f"bleu_{i}_token_ids"] = score
+
         generated_sents = gen_and_ref_sentences["generated_sentences"]
         generated_sents_normal = gen_and_ref_sentences["generated_sentences_normal_selected_regions"]
         generated_sents_abnormal = gen_and_ref_sentences["generated_sentences_abnormal_selected_regions"]
@@ -417,6 +596,9 @@ def compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports):
 
         compute_sent_level_meteor_ratio_score(generated_sents, reference_sents)
 
+        if special_token_id is not None and len(gen_and_ref_sentences["generated_sentences_ids"]) != 0:
+            compute_corpus_level_token_id_bleu_scores()
+
         for region_index, region_name in enumerate(ANATOMICAL_REGIONS):
             region_generated_sentences = gen_and_ref_sentences[region_index]["generated_sentences"]
             region_reference_sentences = gen_and_ref_sentences[region_index]["reference_sentences"]
@@ -483,7 +665,8 @@ def compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports):
         language_model_scores["report"]["CE"]["f1_example_all"] = None
         language_model_scores["report"]["CE"]["acc_example_all"] = None
 
-        # on sentence-level, we only evaluate on METEOR, since this metric gives meaningful scores on sentence-level (as opposed to e.g. BLEU)
+        # on sentence-level, we mainly evaluate on METEOR, since this metric gives meaningful scores on sentence-level (as opposed to e.g. BLEU)
+        # (corpus-level BLEU 1-4 on the token ids of all generated sentences are additionally added as "bleu_{n}_token_ids" in compute_corpus_level_token_id_bleu_scores if the token ids are available)
         # we distinguish between generated sentences for all, normal, and abnormal regions
         for subset in ["all", "normal", "abnormal"]:
             language_model_scores[subset] = {"meteor": None}
@@ -606,19 +789,17 @@ def get_plot_title(region_set, region_indices, region_colors, class_detected_img
     return ", ".join(region_set[:3]) + "\n" + ", ".join(region_set[3:])
 
 
-def get_generated_sentence_for_region(
-    generated_sentences_for_selected_regions, selected_regions, num_img, region_index
-) -> str:
+def get_generated_sentence_indices(selected_regions) -> np.array:
     """
     Args:
-        generated_sentences_for_selected_regions (List[str]): holds the generated sentences for all regions that were selected in the batch, i.e. of length "num_regions_selected_in_batch"
-        selected_regions (Tensor[bool]): of shape [batch_size x 29], specifies for each region if it was selected to get a sentences generated (True) or not by the binary classifier for region selection.
+        selected_regions (np.array[bool]): of shape [batch_size x 29], specifies for each region if it was selected to get a sentences generated (True) or not by the binary classifier for region selection.
         Ergo has exactly "num_regions_selected_in_batch" True values.
-        num_img (int): specifies the image we are currently processing in the batch, its value is in the range [0, batch_size-1]
-        region_index (int): specifies the region we are currently processing of a single image, its value is in the range [0, 28]
 
     Returns:
-        str: generated sentence for region specified by num_img and region_index
+        generated_sentence_indices (np.array[int]): of shape [batch_size x 29], holds for every selected region the index of its generated sentence
+        in generated_sentences_for_selected_regions (the values for not selected regions are meaningless)
+
+    This only has to be computed once per batch (and not for every region of every image), since it's the same for all regions.
 
     Implementation is not too easy to understand, so here is a toy example with some toy values to explain.
 
@@ -627,12 +808,10 @@ def get_generated_sentence_for_region(
         [False, False, True],
         [True, False, False]
     ]
-    num_img = 0
-    region_index = 2
 
     In this toy example, the batch_size = 2 and there are only 3 regions in total for simplicity (instead of the 29).
     The generated_sentences_for_selected_regions is of len 2, meaning num_regions_selected_in_batch = 2.
-    Therefore, the selected_regions boolean tensor also has exactly 2 True values.
+    Therefore, the selected_regions boolean array also has exactly 2 True values.
 
     (1) Flatten selected_regions:
         selected_regions_flat = [False, False, True, True, False, False]
@@ -646,18 +825,15 @@ def get_generated_sentence_for_region(
             [2, 2, 2]
         ]
 
-    (4) Subtract 1 from tensor, such that 1st True value in selected_regions has the index value 0 in cum_sum_true_values,
+    (4) Subtract 1 from array, such that 1st True value in selected_regions has the index value 0 in cum_sum_true_values,
         the 2nd True value has index value 1 and so on.
-        cum_sum_true_values = [
+        generated_sentence_indices = [
             [-1, -1, 0],
             [1, 1, 1]
         ]
 
-    (5) Index cum_sum_true_values with num_img and region_index to get the final index for the generated sentence list
-        index = cum_sum_true_values[num_img][region_index] = cum_sum_true_values[0][2] = 0
-
-    (6) Get generated sentence:
-        generated_sentences_for_selected_regions[index] = "Heart is ok."
+    E.g. for num_img = 0 and region_index = 2, the index for the generated sentence list is generated_sentence_indices[0][2] = 0,
+    such that the generated sentence is generated_sentences_for_selected_regions[0] = "Heart is ok." (see get_generated_sentence_for_region)
     """
     selected_regions_flat = selected_regions.reshape(-1)
     cum_sum_true_values = np.cumsum(selected_regions_flat)
@@ -665,34 +841,45 @@ def get_generated_sentence_for_region(
     cum_sum_true_values = cum_sum_true_values.reshape(selected_regions.shape)
     cum_sum_true_values -= 1
 
-    index = cum_sum_true_values[num_img][region_index]
+    return cum_sum_true_values
+
+
+def get_generated_sentence_for_region(
+    generated_sentences_for_selected_regions, generated_sentence_indices, num_img, region_index
+) -> str:
+    """
+    Args:
+        generated_sentences_for_selected_regions (List[str]): holds the generated sentences for all regions that were selected in the batch, i.e. of length "num_regions_selected_in_batch"
+        generated_sentence_indices (np.array[int]): of shape [batch_size x 29], see get_generated_sentence_indices
+        num_img (int): specifies the image we are currently processing in the batch, its value is in the range [0, batch_size-1]
+        region_index (int): specifies the region we are currently processing of a single image, its value is in the range [0, 28]
+
+    Returns:
+        str: generated sentence for region specified by num_img and region_index
+    """
+    index = generated_sentence_indices[num_img][region_index]
 
     return generated_sentences_for_selected_regions[index]
 
 
+@functools.lru_cache(maxsize=4096)
 def transform_sentence_to_fit_under_image(sentence):
     """
     Adds line breaks and whitespaces such that long reference or generated sentence
     fits under the plotted image.
     Values like max_line_length and prefix_for_alignment were found by trial-and-error.
+
+    The results are cached, since the same (reference) sentences occur for many images.
     """
     max_line_length = 60
     if len(sentence) < max_line_length:
         return sentence
 
-    words = sentence.split()
-    transformed_sent = ""
-    current_line_length = 0
+    # lines are only broken at whitespaces (i.e. words are never split up)
+    lines = textwrap.wrap(sentence, width=max_line_length, break_long_words=False, break_on_hyphens=False)
     prefix_for_alignment = "\n" + " " * 20
-    for word in words:
-        if len(word) + current_line_length > max_line_length:
-            word = f"{prefix_for_alignment}{word}"
-            current_line_length = -len(prefix_for_alignment)
-
-        current_line_length += len(word)
-        transformed_sent += word + " "
 
-    return transformed_sent
+    return prefix_for_alignment.join(lines)
 
 
 def update_region_set_text(
@@ -702,6 +889,7 @@ def update_region_set_text(
     generated_sentences_for_selected_regions,
     region_index,
     selected_regions,
+    generated_sentence_indices,
     num_img,
 ):
     """
@@ -738,7 +926,7 @@ def update_region_set_text(
         region_set_text += "  generated: [REGION NOT SELECTED]\n\n"
     else:
         generated_sentence_region = get_generated_sentence_for_region(
-            generated_sentences_for_selected_regions, selected_regions, num_img, region_index
+            generated_sentences_for_selected_regions, generated_sentence_indices, num_img, region_index
         )
         generated_sentence_region = transform_sentence_to_fit_under_image(generated_sentence_region)
         region_set_text += f"  generated: {generated_sentence_region}\n\n"
@@ -759,74 +947,133 @@ def plot_box(box, ax, clr, linestyle, region_detected=True):
         ax.annotate("not detected", (x0, y0), color=clr, weight="bold", fontsize=10)
 
 
+def get_plot_figure_and_axes():
+    """
+    Returns the figure and axes that are reused for all plots (they are created on the first call).
+    The axes are cleared, such that nothing of the previous plot remains.
+
+    Only the single worker thread of plot_executor calls this function, so the figure is never used by 2 threads at once.
+    """
+    global plot_fig, plot_ax
+
+    if plot_fig is None:
+        plot_fig = Figure(figsize=(8, 8))
+        FigureCanvasAgg(plot_fig)
+        plot_ax = plot_fig.add_subplot()
+    else:
+        plot_ax.clear()
+
+    return plot_fig, plot_ax
+
+
+def render_and_write_region_set_to_tensorboard(
+    writer,
+    tag,
+    overall_steps_taken,
+    image,
+    gt_boxes_region_set,
+    pred_boxes_region_set,
+    region_detected_region_set,
+    region_colors,
+    title,
+    region_set_text,
+):
+    """
+    Plots the gt and predicted boxes of a single region_set onto the image and writes the resulting figure to tensorboard.
+
+    This function is run in the background by plot_executor (see plot_detections_and_sentences_to_tensorboard),
+    which is why it only receives numpy arrays/python objects (i.e. no cuda tensors) and uses the object-oriented matplotlib API
+    instead of pyplot (since pyplot is not thread-safe).
+
+    Args:
+        image (np.array): of shape [H x W x 1]
+        gt_boxes_region_set (np.array): of shape [num_regions_in_region_set x 4]
+        pred_boxes_region_set (np.array): of shape [num_regions_in_region_set x 4]
+        region_detected_region_set (List[bool]): of len num_regions_in_region_set
+    """
+    fig, ax = get_plot_figure_and_axes()
+
+    ax.imshow(image, cmap="gray")
+    ax.axis("on")
+
+    for box_gt, box_pred, box_region_detected, color in zip(gt_boxes_region_set, pred_boxes_region_set, region_detected_region_set, region_colors):
+        plot_box(box_gt, ax, clr=color, linestyle="solid", region_detected=box_region_detected)
+
+        # only plot predicted box if class was actually detected
+        if box_region_detected:
+            plot_box(box_pred, ax, clr=color, linestyle="dashed")
+
+    ax.set_title(title)
+    ax.set_xlabel(region_set_text, loc="left")
+
+    # using writer.add_figure does not correctly display the region_set_text in tensorboard
+    # so instead, fig is first saved as a png file to memory via BytesIO
+    # (this also saves the region_set_text correctly in the png when bbox_inches="tight" is set)
+    # then the png is loaded from memory and the 4th channel (alpha channel) is discarded
+    # finally, writer.add_image is used to display the image in tensorboard
+    buf = io.BytesIO()
+    fig.savefig(buf, bbox_inches="tight")
+    buf.seek(0)
+    im = Image.open(buf)
+    im = np.asarray(im)[..., :3]
+
+    writer.add_image(
+        tag,
+        im,
+        global_step=overall_steps_taken,
+        dataformats="HWC",
+    )
+
+
 def plot_detections_and_sentences_to_tensorboard(
     writer,
     num_batch,
     overall_steps_taken,
     images,
-    image_targets,
+    gt_boxes_batch,
     selected_regions,
     detections,
     class_detected,
     reference_sentences,
     generated_sentences_for_selected_regions,
 ):
+    """
+    gt_boxes_batch (Tensor) of shape [batch_size x 29 x 4] holds the stacked gt boxes of the images (on the cpu).
+
+    The figures are rendered and written to tensorboard in the background by plot_executor (such that the generation of the next batches
+    is not blocked by matplotlib). The returned list of futures has to be waited on before the evaluation finishes.
+    """
     # pred_boxes_batch is of shape [batch_size x 29 x 4] and contains the predicted region boxes with the highest score (i.e. top-1)
     # they are sorted in the 2nd dimension, meaning the 1st of the 29 boxes corresponds to the 1st region/class,
     # the 2nd to the 2nd class and so on
-    pred_boxes_batch = detections["top_region_boxes"]
+    # (all tensors are converted to numpy arrays before they are passed to plot_executor)
+    pred_boxes_batch = detections["top_region_boxes"].detach().cpu().numpy()
+    gt_boxes_batch = gt_boxes_batch.numpy()
 
-    # image_targets is a list of dicts, with each dict containing the key "boxes" that contain the gt boxes of a single image
-    # gt_boxes is of shape [batch_size x 29 x 4]
-    gt_boxes_batch = torch.stack([t["boxes"] for t in image_targets], dim=0)
+    # put channel dimension (1st dim) last (0-th dim is batch-dim)
+    images = images.numpy().transpose(0, 2, 3, 1)
 
-    # plot 6 regions at a time, as to not overload the image with boxes (except for region_set_5, which has 5 regions)
-    # the region_sets were chosen as to minimize overlap between the contained regions (i.e. better visibility)
-    region_set_1 = ["right lung", "right costophrenic angle", "left lung", "left costophrenic angle", "cardiac silhouette", "spine"]
-    region_set_2 = ["right upper lung zone", "right mid lung zone", "right lower lung zone", "left upper lung zone", "left mid lung zone", "left lower lung zone"]
-    region_set_3 = ["right hilar structures", "right apical zone", "left hilar structures", "left apical zone", "right hemidiaphragm", "left hemidiaphragm"]
-    region_set_4 = ["trachea", "right clavicle", "left clavicle", "aortic arch", "abdomen", "right atrium"]
-    region_set_5 = ["mediastinum", "svc", "cavoatrial junction", "carina", "upper mediastinum"]
+    # compute the indices of the generated sentences once for the whole batch (instead of for every region of every image)
+    generated_sentence_indices = get_generated_sentence_indices(selected_regions)
 
-    regions_sets = [region_set_1, region_set_2, region_set_3, region_set_4, region_set_5]
+    # move class_detected to cpu once (instead of once per image)
+    class_detected = class_detected.detach().cpu().tolist()
 
-    # put channel dimension (1st dim) last (0-th dim is batch-dim)
-    images = images.numpy().transpose(0, 2, 3, 1)
+    plot_futures = []
 
     for num_img, image in enumerate(images):
 
         gt_boxes_img = gt_boxes_batch[num_img]
         pred_boxes_img = pred_boxes_batch[num_img]
-        class_detected_img = class_detected[num_img].tolist()
+        class_detected_img = class_detected[num_img]
         reference_sentences_img = reference_sentences[num_img]
 
-        for num_region_set, region_set in enumerate(regions_sets):
-            fig = plt.figure(figsize=(8, 8))
-            ax = plt.gca()
-
-            plt.imshow(image, cmap="gray")
-            plt.axis("on")
-
-            region_indices = [ANATOMICAL_REGIONS[region] for region in region_set]
-            region_colors = ["b", "g", "r", "c", "m", "y"]
-
-            if num_region_set == 4:
-                region_colors.pop()
+        for num_region_set, (region_set, region_indices) in enumerate(zip(REGION_SETS, REGION_INDICES)):
+            region_colors = REGION_COLORS[:len(region_set)]
 
             region_set_text = ""
 
             for region_index, color in zip(region_indices, region_colors):
-                # box_gt and box_pred are both [List[float]] of len 4
-                box_gt = gt_boxes_img[region_index].tolist()
-                box_pred = pred_boxes_img[region_index].tolist()
-                box_region_detected = class_detected_img[region_index]
-
-                plot_box(box_gt, ax, clr=color, linestyle="solid", region_detected=box_region_detected)
-
-                # only plot predicted box if class was actually detected
-                if box_region_detected:
-                    plot_box(box_pred, ax, clr=color, linestyle="dashed")
-
                 region_set_text = update_region_set_text(
                     region_set_text,
                     color,
@@ -834,34 +1081,31 @@ def plot_detections_and_sentences_to_tensorboard(
                     generated_sentences_for_selected_regions,
                     region_index,
                     selected_regions,
+                    generated_sentence_indices,
                     num_img,
                 )
 
             title = get_plot_title(region_set, region_indices, region_colors, class_detected_img)
-            ax.set_title(title)
-
-            plt.xlabel(region_set_text, loc="left")
-
-            # using writer.add_figure does not correctly display the region_set_text in tensorboard
-            # so instead, fig is first saved as a png file to memory via BytesIO
-            # (this also saves the region_set_text correctly in the png when bbox_inches="tight" is set)
-            # then the png is loaded from memory and the 4th channel (alpha channel) is discarded
-            # finally, writer.add_image is used to display the image in tensorboard
-            buf = io.BytesIO()
-            fig.savefig(buf, bbox_inches="tight")
-            buf.seek(0)
-            im = Image.open(buf)
-            im = np.asarray(im)[..., :3]
 
             writer_image_num = num_batch * BATCH_SIZE + num_img
-            writer.add_image(
-                f"img_{writer_image_num}_region_set_{num_region_set}",
-                im,
-                global_step=overall_steps_taken,
-                dataformats="HWC",
+
+            plot_futures.append(
+                plot_executor.submit(
+                    render_and_write_region_set_to_tensorboard,
+                    writer,
+                    f"img_{writer_image_num}_region_set_{num_region_set}",
+                    overall_steps_taken,
+                    image,
+                    gt_boxes_img[region_indices],
+                    pred_boxes_img[region_indices],
+                    [class_detected_img[region_index] for region_index in region_indices],
+                    region_colors,
+                    title,
+                    region_set_text,
+                )
             )
 
-            plt.close(fig)
+    return plot_futures
 
 
 def update_gen_sentences_with_corresponding_regions(
@@ -985,12 +1229,49 @@ def update_gen_and_ref_sentences_for_regions(
 
             index_gen_ref_sentence += 1
 
-def get_generated_reports(generated_sentences_for_selected_regions, selected_regions, sentence_tokenizer, bertscore_threshold, bert_score):
+def get_bert_scorer(batch_size=32):
+    """
+    Instantiates the BERTScorer (with the distilbert model) once, such that the model is not reloaded every time
+    the bertscores of generated sentences are computed (see get_generated_reports).
+    """
+    return BERTScorer(model_type="distilbert-base-uncased", lang="en", device=str(device), batch_size=batch_size)
+
+
+def compute_bert_score_f1(bert_scorer, candidates: list[str], references: list[str]) -> list[float]:
+    """
+    Computes the bertscore f1 for every (candidate, reference) pair in a single batched call.
+
+    If the batch of BERT forward passes does not fit into GPU memory, the batch size of bert_scorer is halved until it does.
+    If an OOM already happens for a batch size of 1, the bert model is moved to the cpu as a last resort.
+    The reduced batch size (or cpu device) is kept for all subsequent calls.
+    """
+    while True:
+        try:
+            _, _, f1 = bert_scorer.score(candidates, references, batch_size=bert_scorer.batch_size)
+            return f1.tolist()
+        except RuntimeError as e:  # out of memory error
+            if "out of memory" not in str(e):
+                raise e
+
+            torch.cuda.empty_cache()
+
+            if bert_scorer.batch_size > 1:
+                bert_scorer.batch_size //= 2
+            elif bert_scorer.device != "cpu":
+                bert_scorer._model.to("cpu")
+                bert_scorer.device = "cpu"
+            else:
+                raise e
+
+
+def get_generated_reports(generated_sentences_for_selected_regions, selected_regions, sentence_tokenizer, bertscore_threshold, bert_scorer):
     """
     Args:
         generated_sentences_for_selected_regions (List[str]): of length "num_regions_selected_in_batch"
         selected_regions ([batch_size x 29]): boolean array that has exactly "num_regions_selected_in_batch" True values
         sentence_tokenizer: used in remove_duplicate_generated_sentences to separate the generated sentences
+        bertscore_threshold (float): generated sentences with a bertscore f1 above the threshold are considered too similar
+        bert_scorer (BERTScorer): see get_bert_scorer
 
     Return:
         generated_reports (List[str]): list of length batch_size containing generated reports for every image in batch
@@ -998,7 +1279,7 @@ def get_generated_reports(generated_sentences_for_selected_regions, selected_reg
         of other generated sentences that were removed because they were too similar. Useful for manually verifying if removing similar generated sentences was successful
     """
     @torch.no_grad()
-    def remove_duplicate_generated_sentences(gen_report_single_image, bert_score):
+    def remove_duplicate_generated_sentences(gen_report_single_image, bert_scorer):
         def check_gen_sent_in_sents_to_be_removed(gen_sent, similar_generated_sents_to_be_removed):
             for lists_of_gen_sents_to_be_removed in similar_generated_sents_to_be_removed.values():
                 if gen_sent in lists_of_gen_sents_to_be_removed:
@@ -1026,6 +1307,18 @@ def get_generated_reports(generated_sentences_for_selected_regions, selected_reg
         # similar_generated_sents_to_be_removed maps from one sentence to a list of similar sentences that are to be removed
         similar_generated_sents_to_be_removed = defaultdict(list)
 
+        # compute the bertscores of all pairs of generated sentences at once (instead of 1 bertscore call per pair in the loops below),
+        # such that the BERT forward passes are batched
+        sentence_pairs = [(i, j) for i in range(len(gen_sents_single_image)) for j in range(i + 1, len(gen_sents_single_image))]
+
+        if len(sentence_pairs) != 0:
+            bert_score_f1s = compute_bert_score_f1(
+                bert_scorer,
+                [gen_sents_single_image[i] for i, _ in sentence_pairs],
+                [gen_sents_single_image[j] for _, j in sentence_pairs],
+            )
+            bert_score_f1_per_pair = dict(zip(sentence_pairs, bert_score_f1s))
+
         # TODO:
         # the nested for loops below check each generated sentence with every other generated sentence
         # this is not particularly efficient, since e.g. generated sentences for the region "right lung" most likely
@@ -1043,18 +1336,12 @@ def get_generated_reports(generated_sentences_for_selected_regions, selected_reg
                 if check_gen_sent_in_sents_to_be_removed(gen_sent_2, similar_generated_sents_to_be_removed):
                     continue
 
-                bert_score_result = bert_score.compute(
-                    lang="en", predictions=[gen_sent_1], references=[gen_sent_2], model_type="distilbert-base-uncased"
-                )
-
-                if bert_score_result["f1"][0] > bertscore_threshold:
+                if bert_score_f1_per_pair[(i, j)] > bertscore_threshold:
                     # remove the generated similar sentence that is shorter
                     if len(gen_sent_1) > len(gen_sent_2):
                         similar_generated_sents_to_be_removed[gen_sent_1].append(gen_sent_2)
                     else:
                         similar_generated_sents_to_be_removed[gen_sent_2].append(gen_sent_1)
-                
-                # del bert_score_result
 
         gen_report_single_image = " ".join(
             sent for sent in gen_sents_single_image if not check_gen_sent_in_sents_to_be_removed(sent, similar_generated_sents_to_be_removed)
@@ -1082,10 +1369,8 @@ def get_generated_reports(generated_sentences_for_selected_regions, selected_reg
         gen_report_single_image = " ".join(sent for sent in gen_sents_single_image)
 
         gen_report_single_image, similar_generated_sents_to_be_removed = remove_duplicate_generated_sentences(
-            gen_report_single_image, bert_score
+            gen_report_single_image, bert_scorer
         )
-        
-        # del bert_score
 
         generated_reports.append(gen_report_single_image)
         removed_similar_generated_sentences.append(similar_generated_sents_to_be_removed)
@@ -1099,26 +1384,34 @@ def get_ref_sentences_for_selected_regions(reference_sentences, selected_regions
         reference_sentences (List[List[str]]): outer list has len batch_size, inner list has len 29 (the inner list holds all reference phrases of a single image)
         selected_regions ([batch_size x 29]): boolean array that has exactly "num_regions_selected_in_batch" True values
     """
-    # array of shape [batch_size x 29]
-    reference_sentences = np.asarray(reference_sentences)
+    # flatten reference_sentences into a list of len (batch_size * 29), which has the same order as the flattened selected_regions
+    # (this avoids building a (string) numpy array for every batch)
+    reference_sentences_flat = [ref_sent for ref_sents_single_image in reference_sentences for ref_sent in ref_sents_single_image]
 
-    ref_sentences_for_selected_regions = reference_sentences[selected_regions]
+    ref_sentences_for_selected_regions = [reference_sentences_flat[index] for index in np.flatnonzero(selected_regions)]
 
-    return ref_sentences_for_selected_regions.tolist()
+    return ref_sentences_for_selected_regions
 
 
 def get_sents_for_normal_abnormal_selected_regions(region_is_abnormal, selected_regions, generated_sentences_for_selected_regions, reference_sentences_for_selected_regions):
     selected_region_is_abnormal = region_is_abnormal[selected_regions]
     # selected_region_is_abnormal is a bool array of shape [num_regions_selected_in_batch] that specifies if a selected region is abnormal (True) or normal (False)
 
-    gen_sents_for_selected_regions = np.asarray(generated_sentences_for_selected_regions)
-    ref_sents_for_selected_regions = np.asarray(reference_sentences_for_selected_regions)
+    selected_region_is_abnormal = selected_region_is_abnormal.tolist()
 
-    gen_sents_for_normal_selected_regions = gen_sents_for_selected_regions[~selected_region_is_abnormal].tolist()
-    gen_sents_for_abnormal_selected_regions = gen_sents_for_selected_regions[selected_region_is_abnormal].tolist()
+    gen_sents_for_normal_selected_regions = []
+    gen_sents_for_abnormal_selected_regions = []
+    ref_sents_for_normal_selected_regions = []
+    ref_sents_for_abnormal_selected_regions = []
 
-    ref_sents_for_normal_selected_regions = ref_sents_for_selected_regions[~selected_region_is_abnormal].tolist()
-    ref_sents_for_abnormal_selected_regions = ref_sents_for_selected_regions[selected_region_is_abnormal].tolist()
+    # split the generated and reference sentences into normal and abnormal ones (without converting them into numpy arrays first)
+    for gen_sent, ref_sent, is_abnormal in zip(generated_sentences_for_selected_regions, reference_sentences_for_selected_regions, selected_region_is_abnormal):
+        if is_abnormal:
+            gen_sents_for_abnormal_selected_regions.append(gen_sent)
+            ref_sents_for_abnormal_selected_regions.append(ref_sent)
+        else:
+            gen_sents_for_normal_selected_regions.append(gen_sent)
+            ref_sents_for_normal_selected_regions.append(ref_sent)
 
     return (
         gen_sents_for_normal_selected_regions,
@@ -1128,11 +1421,115 @@ def get_sents_for_normal_abnormal_selected_regions(region_is_abnormal, selected_
     )
 
 
+def get_model_hash(model):
+    """
+    Computes a fingerprint of the full model state (all parameters and buffers) for the keys of the generation cache.
+    The values are concatenated before they are transferred to the cpu, such that there is only 1 transfer.
+
+    Note that the fingerprint only covers the weights, not the model code. The cache directory (path_generation_cache)
+    therefore has to be cleared manually whenever the code of the model or of the generation changes.
+    """
+    model_state_values = torch.cat([value.detach().reshape(-1).float() for value in model.state_dict().values()])
+
+    return hashlib.sha1(model_state_values.cpu().numpy().tobytes()).hexdigest()
+
+
+def get_batch_hash(images, reference_reports):
+    """
+    Computes a fingerprint of the samples of a batch (their images and reference reports) for the keys of the generation cache,
+    such that a cached output is never loaded for a batch with different images (e.g. with a different batch size or val set).
+    """
+    batch_hash = hashlib.sha1(images.numpy().tobytes())
+
+    for reference_report in reference_reports:
+        batch_hash.update(reference_report.encode())
+
+    return batch_hash.hexdigest()
+
+
+def get_generation_cache_path(model_hash, batch_hash, num_batch, val_dl):
+    """
+    The outputs of model.generate are deterministic given the model weights, the generation parameters and the batch.
+    They are cached on disk under path_generation_cache, such that evaluations with unchanged weights
+    (e.g. re-running an evaluation after a crash) can skip the generation.
+
+    Besides the fingerprints of the weights and of the samples of the batch, the key contains the batch index, the batch size,
+    the dataset length, the rank and world size, and the generation parameters.
+
+    A DistributedSampler shuffles by default, in which case the batches depend on the seed and epoch of the sampler,
+    so they are added to the cache key as well (a DistributedSampler with shuffle=False is preferable, since it keeps the cache valid over epochs).
+    """
+    rank = dist.get_rank() if is_dist_initialized() else 0
+    file_name = (
+        f"{model_hash}_{batch_hash}_rank_{rank}_of_{get_world_size()}_batch_{num_batch}_batch_size_{val_dl.batch_size}"
+        f"_dataset_len_{len(val_dl.dataset)}_beams_{NUM_BEAMS}_max_tokens_{MAX_NUM_TOKENS_GENERATE}.pt"
+    )
+
+    if isinstance(val_dl.sampler, DistributedSampler) and val_dl.sampler.shuffle:
+        file_name = f"seed_{val_dl.sampler.seed}_epoch_{val_dl.sampler.epoch}_{file_name}"
+
+    return os.path.join(path_generation_cache, file_name)
+
+
+def move_generation_output_to_cpu(output):
+    # output == -1 if the region features that would have been passed into the language model were empty
+    if output == -1:
+        return output
+
+    beam_search_output, selected_regions, detections, class_detected = output
+    detections = {k: v.cpu() for k, v in detections.items()}
+
+    return beam_search_output.cpu(), selected_regions.cpu(), detections, class_detected.cpu()
+
+
+def gather_gen_and_ref_sentences_and_reports(gen_and_ref_sentences, gen_and_ref_reports):
+    """
+    Gathers the generated and reference sentences and reports of all ranks on the main process (rank 0),
+    for the case that every rank generated the sentences for a different shard of val_dl (e.g. by using a DistributedSampler).
+
+    Returns the merged gen_and_ref_sentences and gen_and_ref_reports dicts on the main process, and (None, None) on all other ranks.
+    """
+    # gather_object pickles the objects, so the token id tensors are moved to the cpu first
+    for key in ["generated_sentences_ids", "reference_sentences_ids"]:
+        gen_and_ref_sentences[key] = [ids.cpu() for ids in gen_and_ref_sentences[key]]
+
+    gathered = [None] * get_world_size() if is_main_process() else None
+    dist.gather_object((gen_and_ref_sentences, gen_and_ref_reports), gathered, dst=0)
+
+    if not is_main_process():
+        return None, None
+
+    gen_and_ref_sentences, gen_and_ref_reports = gathered[0]
+
+    for gen_and_ref_sentences_rank, gen_and_ref_reports_rank in gathered[1:]:
+        for key, value in gen_and_ref_sentences_rank.items():
+            # the per region entries (with the region indices as keys) are dicts that hold the generated and reference sentences of the region
+            if isinstance(value, dict):
+                for sentences_type, sentences in value.items():
+                    gen_and_ref_sentences[key][sentences_type].extend(sentences)
+            else:
+                gen_and_ref_sentences[key].extend(value)
+
+        for key, value in gen_and_ref_reports_rank.items():
+            gen_and_ref_reports[key].extend(value)
+
+    return gen_and_ref_sentences, gen_and_ref_reports
+
+
 def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, generated_sentences_and_reports_folder_path):
+    """
+    If torch.distributed is initialized, every rank is expected to iterate over a different shard of val_dl, i.e. val_dl has to use a
+    DistributedSampler (preferably with shuffle=False, see get_generation_cache_path). The model can be passed wrapped in DistributedDataParallel.
+    The generated and reference sentences are then gathered on the main process, which computes and returns the language model scores
+    (all other ranks return None). Only the main process plots images to tensorboard and writes the generated sentences and reports to file.
+    """
     epoch = run_params["epoch"]
     overall_steps_taken = run_params["overall_steps_taken"]
     log_file = run_params["log_file"]
 
+    # generate is only defined on the model itself (and not on a DistributedDataParallel wrapper around it)
+    model = getattr(model, "module", model)
+
     # whilst iterating over the validation loader, save the (all, normal, abnormal) generated and reference sentences in the respective lists
     # the list under the key "num_generated_sentences_per_image" will hold integers that represent how many sentences were generated for each image
     # this is useful to be able to get all generated and reference sentences that correspond to the same image
@@ -1144,7 +1541,10 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
         "reference_sentences": [],
         "reference_sentences_normal_selected_regions": [],
         "reference_sentences_abnormal_selected_regions": [],
-        "num_generated_sentences_per_image": []
+        "num_generated_sentences_per_image": [],
+        # token ids of the generated and reference sentences (one tensor per batch) for computing BLEU (see tensor_bleu)
+        "generated_sentences_ids": [],
+        "reference_sentences_ids": [],
     }
 
     # also save the generated and reference sentences on a per region basis
@@ -1173,22 +1573,36 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
     gen_sentences_with_corresponding_regions = []
 
     # we also want to plot a couple of images
-    num_batches_to_process_for_image_plotting = NUM_IMAGES_TO_PLOT // BATCH_SIZE
+    # (only the main process writes to tensorboard)
+    num_batches_to_process_for_image_plotting = NUM_IMAGES_TO_PLOT // BATCH_SIZE if is_main_process() else 0
+
+    # the batches used for the evaluation are split up between all ranks
+    num_batches_to_process = max(1, NUM_BATCHES_TO_PROCESS_FOR_LANGUAGE_MODEL_EVALUATION // get_world_size())
+
+    # futures of the figures that are rendered in the background (see plot_detections_and_sentences_to_tensorboard)
+    plot_futures = []
 
     # to recover from out of memory error if a batch has a sequence that is too long
     oom = False
 
     # used in function get_generated_reports
     sentence_tokenizer = spacy.load("en_core_web_trf")
+    bert_scorer = get_bert_scorer()
 
-    with torch.no_grad():
-        for num_batch, batch in tqdm(enumerate(val_dl), total=NUM_BATCHES_TO_PROCESS_FOR_LANGUAGE_MODEL_EVALUATION):
+    # the outputs of model.generate are only cached on disk if path_generation_cache is specified (see get_generation_cache_path)
+    if path_generation_cache is not None:
+        os.makedirs(path_generation_cache, exist_ok=True)
+        model_hash = get_model_hash(model)
+
+    # inference_mode is cheaper than no_grad, since it additionally disables the view and version counter tracking of tensors
+    with torch.inference_mode():
+        for num_batch, batch in tqdm(enumerate(val_dl), total=num_batches_to_process):
             # since generating sentences takes some time, we limit the number of batches used to compute bleu/rouge-l/meteor
-            if num_batch >= NUM_BATCHES_TO_PROCESS_FOR_LANGUAGE_MODEL_EVALUATION:
+            if num_batch >= num_batches_to_process:
                 break
 
             images = batch["images"]  # shape [batch_size x 1 x 512 x 512]
-            image_targets = batch["image_targets"]
+            image_targets_boxes = batch["image_targets_boxes"]  # shape [(batch_size * 29) x 4], the concatenated gt boxes of all images
             region_is_abnormal = batch["region_is_abnormal"].numpy()  # boolean array of shape [batch_size x 29]
 
             # List[List[str]] that holds the reference phrases. The inner list holds all reference phrases of a single image
@@ -1197,30 +1611,48 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
             # List[str] that holds the reference report for the images in the batch
             reference_reports = batch["reference_reports"]
 
-            try:
-                with torch.autocast(device_type='cuda', dtype=torch.float16):
-                    output = model.generate(
-                        images.to(device, non_blocking=True),
-                        max_length=MAX_NUM_TOKENS_GENERATE,
-                        num_beams=NUM_BEAMS,
-                        early_stopping=True,
-                    )
-            except RuntimeError as e:  # out of memory error
-                if "out of memory" in str(e):
-                    oom = True
-
-                    with open(log_file, "a") as f:
-                        f.write("Generation:\n")
-                        f.write(f"OOM at epoch {epoch}, batch number {num_batch}.\n")
-                        f.write(f"Error message: {str(e)}\n\n")
-                else:
-                    raise e
+            # tensor of shape [(batch_size * 29) x seq_len] that holds the token ids of the reference phrases
+            input_ids = batch["input_ids"]
 
-            if oom:
-                # free up memory
-                torch.cuda.empty_cache()
-                oom = False
-                continue
+            if path_generation_cache is not None:
+                generation_cache_path = get_generation_cache_path(model_hash, get_batch_hash(images, reference_reports), num_batch, val_dl)
+            else:
+                generation_cache_path = None
+
+            images = pin_for_non_blocking_copy(images, device)
+
+            if generation_cache_path is not None and os.path.exists(generation_cache_path):
+                # the cached outputs are on the cpu, which is fine since everything below either needs them on the cpu
+                # or moves them to the device itself (e.g. tensor_bleu)
+                output = torch.load(generation_cache_path)
+            else:
+                try:
+                    with torch.autocast(device_type='cuda', dtype=eval_autocast_dtype):
+                        output = model.generate(
+                            images.to(device, non_blocking=True),
+                            max_length=MAX_NUM_TOKENS_GENERATE,
+                            num_beams=NUM_BEAMS,
+                            early_stopping=True,
+                        )
+                except RuntimeError as e:  # out of memory error
+                    if "out of memory" in str(e):
+                        oom = True
+
+                        with open(log_file, "a") as f:
+                            f.write("Generation:\n")
+                            f.write(f"OOM at epoch {epoch}, batch number {num_batch}.\n")
+                            f.write(f"Error message: {str(e)}\n\n")
+                    else:
+                        raise e
+
+                if oom:
+                    # free up memory
+                    torch.cuda.empty_cache()
+                    oom = False
+                    continue
+
+                if generation_cache_path is not None:
+                    torch.save(move_generation_output_to_cpu(output), generation_cache_path)
 
             # output == -1 if the region features that would have been passed into the language model were empty (see forward method for more details)
             if output == -1:
@@ -1235,8 +1667,10 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
                 selected_regions = selected_regions.detach().cpu().numpy()
 
             # generated_sents_for_selected_regions is a List[str] of length "num_regions_selected_in_batch"
+            # (the decoded sentences are needed for every batch, e.g. to compute METEOR and to build the generated reports,
+            # but the ids are transferred to the cpu with a single .tolist(), since batch_decode would otherwise transfer every sequence separately)
             generated_sents_for_selected_regions = tokenizer.batch_decode(
-                beam_search_output, skip_special_tokens=True, clean_up_tokenization_spaces=True
+                beam_search_output.tolist(), skip_special_tokens=True, clean_up_tokenization_spaces=True
             )
 
             # filter reference_sentences to those that correspond to the generated_sentences for the selected regions.
@@ -1257,7 +1691,8 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
                 generated_sents_for_selected_regions,
                 selected_regions,
                 sentence_tokenizer,
-                BERTSCORE_SIMILARITY_THRESHOLD
+                BERTSCORE_SIMILARITY_THRESHOLD,
+                bert_scorer,
             )
 
             gen_and_ref_sentences["generated_sentences"].extend(generated_sents_for_selected_regions)
@@ -1270,6 +1705,12 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
             gen_and_ref_reports["reference_reports"].extend(reference_reports)
             gen_and_ref_reports["removed_similar_generated_sentences"].extend(removed_similar_generated_sentences)
 
+            # keep the token ids to compute BLEU without decoding (beam_search_output stays on the device)
+            gen_and_ref_sentences["generated_sentences_ids"].append(beam_search_output.detach())
+            gen_and_ref_sentences["reference_sentences_ids"].append(
+                input_ids[torch.from_numpy(selected_regions.reshape(-1))].to(device, non_blocking=True)
+            )
+
             update_gen_and_ref_sentences_for_regions(gen_and_ref_sentences, generated_sents_for_selected_regions, reference_sents_for_selected_regions, selected_regions)
             update_num_generated_sentences_per_image(gen_and_ref_sentences, selected_regions)
 
@@ -1277,12 +1718,15 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
                 update_gen_sentences_with_corresponding_regions(gen_sentences_with_corresponding_regions, generated_sents_for_selected_regions, selected_regions)
 
             if num_batch < num_batches_to_process_for_image_plotting:
-                plot_detections_and_sentences_to_tensorboard(
+                # gt_boxes_batch is of shape [batch_size x 29 x 4]
+                gt_boxes_batch = image_targets_boxes.view(images.size(0), -1, 4)
+
+                plot_futures += plot_detections_and_sentences_to_tensorboard(
                     writer,
                     num_batch,
                     overall_steps_taken,
                     images,
-                    image_targets,
+                    gt_boxes_batch,
                     selected_regions,
                     detections,
                     class_detected,
@@ -1290,6 +1734,21 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
                     generated_sents_for_selected_regions,
                 )
 
+    # free up the memory of the bert model
+    del bert_scorer
+    torch.cuda.empty_cache()
+
+    # wait until all figures are written to tensorboard (calling result() re-raises any exception that happened while plotting)
+    wait(plot_futures)
+    for plot_future in plot_futures:
+        plot_future.result()
+
+    if is_dist_initialized():
+        gen_and_ref_sentences, gen_and_ref_reports = gather_gen_and_ref_sentences_and_reports(gen_and_ref_sentences, gen_and_ref_reports)
+
+        if not is_main_process():
+            return None
+
     write_sentences_and_reports_to_file(
         gen_and_ref_sentences,
         gen_and_ref_reports,
@@ -1298,6 +1757,6 @@ def evaluate_language_model(model, val_dl, tokenizer, writer, run_params, genera
         overall_steps_taken,
     )
 
-    language_model_scores = compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports)
+    language_model_scores = compute_language_model_scores(gen_and_ref_sentences, gen_and_ref_reports, special_token_id=tokenizer.pad_token_id)
 
     return language_model_scores
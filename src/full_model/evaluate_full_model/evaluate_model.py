@@ -23,14 +23,22 @@ evaluate_model and its sub-functions evaluate among other things:
 """
 
 import os
+import queue
+import threading
 
 import torch
-import torchmetrics
+import torch.distributed as dist
 from tqdm import tqdm
 
 from src.dataset.constants import ANATOMICAL_REGIONS
-from src.full_model.evaluate_full_model.evaluate_language_model import evaluate_language_model
+from src.full_model.custom_collator import image_targets_to_device
+from src.full_model.evaluate_full_model.evaluate_language_model import (
+    evaluate_language_model,
+    is_dist_initialized,
+    is_main_process,
+)
 from src.full_model.run_configurations import PRETRAIN_WITHOUT_LM_MODEL, WEIGHT_OBJECT_DETECTOR_LOSS, WEIGHT_BINARY_CLASSIFIER_REGION_SELECTION_LOSS, WEIGHT_BINARY_CLASSIFIER_REGION_ABNORMAL_LOSS, WEIGHT_LANGUAGE_MODEL_LOSS
+from src.utils import eval_autocast_dtype, pin_for_non_blocking_copy, sum_losses
 
 device = torch.device(
     "cuda"
@@ -38,6 +46,67 @@ device = torch.device(
     else ("mps" if torch.backends.mps.is_available() else "cpu")
 )
 
+class TensorboardQueue(queue.Queue):
+    """
+    Queue of (fn, args, kwargs) tuples that are executed by a single worker thread, so the writes happen in the same order as they were issued.
+    The worker thread is only started on the first put (i.e. modules that import this one without writing to tensorboard don't start it).
+
+    If a write fails, the worker thread stays alive (otherwise join would block forever),
+    and the exception is re-raised by join (instead of only being lost in the worker thread).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.worker = None
+        self.error = None
+
+    def put(self, item, block=True, timeout=None):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.execute_items, daemon=True)
+            self.worker.start()
+
+        super().put(item, block, timeout)
+
+    def execute_items(self):
+        while True:
+            fn, args, kwargs = self.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                # only the first error is re-raised by join
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.task_done()
+
+    def join(self):
+        super().join()
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+# the tensorboard writes of write_all_losses_and_scores_to_tensorboard are put into this queue,
+# such that the evaluation does not block on building the summary protobufs and writing them to the event files
+tensorboard_queue = TensorboardQueue()
+
+
+class AsyncWriter:
+    """
+    Small wrapper around a SummaryWriter that puts add_scalar and add_scalars calls into the tensorboard_queue
+    (instead of executing them directly). Call tensorboard_queue.join() to wait until all writes were executed.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def add_scalar(self, *args, **kwargs):
+        tensorboard_queue.put((self.writer.add_scalar, args, kwargs))
+
+    def add_scalars(self, *args, **kwargs):
+        tensorboard_queue.put((self.writer.add_scalars, args, kwargs))
+
 
 def write_all_losses_and_scores_to_tensorboard(
     writer,
@@ -172,118 +241,229 @@ def write_all_losses_and_scores_to_tensorboard(
     writer.add_scalar("lr", current_lr, overall_steps_taken)
 
 
+def get_binary_classifier_counts():
+    """
+    Returns the (initial) counts of true/false positives/negatives that are accumulated over the batches
+    to compute the precision, recall and f1 scores of a binary classifier (see compute_binary_classifier_scores).
+
+    The counts are stored in a single tensor of shape [4] on the device (in the order tp, fp, tn, fn),
+    such that updating them does not require a gpu -> cpu sync every batch, and they can be transferred to the cpu at once in the end.
+    """
+    return torch.zeros(4, dtype=torch.long, device=device)
+
+
+def update_binary_classifier_counts(counts, preds, targets, mask=None):
+    """
+    Args:
+        counts (Tensor): of shape [4], holds the running counts of true/false positives/negatives (in the order tp, fp, tn, fn)
+        preds (Tensor[bool]): the predictions
+        targets (Tensor[bool]): the ground-truth labels (same shape as preds)
+        mask (Tensor[bool]): only the predictions where mask is True are counted (if specified)
+
+    A mask is used instead of boolean indexing, since indexing with a boolean tensor on the gpu syncs with the cpu
+    (to get the number of selected elements).
+    """
+    if mask is None:
+        mask = torch.ones_like(preds)
+
+    counts_batch = torch.stack([
+        torch.sum(preds & targets & mask),
+        torch.sum(preds & ~targets & mask),
+        torch.sum(~preds & ~targets & mask),
+        torch.sum(~preds & targets & mask),
+    ])
+
+    counts.add_(counts_batch)
+
+
+def compute_binary_classifier_scores(counts):
+    """
+    Computes the precision, recall and f1 of the positive class from the accumulated counts
+    (equivalent to average="binary" in sklearn.metric with pos_label=1). Scores with a denominator of 0 are set to 0.0.
+    """
+    # single gpu -> cpu transfer of all 4 counts
+    tp, fp, _, fn = counts.tolist()
+
+    return {
+        "precision": tp / (tp + fp) if tp + fp > 0 else 0.0,
+        "recall": tp / (tp + fn) if tp + fn > 0 else 0.0,
+        "f1": 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0.0,
+    }
+
+
 def update_region_abnormal_metrics(region_abnormal_scores, predicted_abnormal_regions, region_is_abnormal, class_detected):
     """
     Args:
-        region_abnormal_scores (Dict)
+        region_abnormal_scores (Tensor): holds the tp, fp, tn, fn counts
         predicted_abnormal_regions (Tensor[bool]): shape [batch_size x 29]
         region_is_abnormal (Tensor[bool]): shape [batch_size x 29]
         class_detected (Tensor[bool]): shape [batch_size x 29]
 
     We only update/compute the scores for regions that were actually detected by the object detector (specified by class_detected).
     """
-    detected_predicted_abnormal_regions = predicted_abnormal_regions[class_detected]
-    detected_region_is_abnormal = region_is_abnormal[class_detected]
-
-    region_abnormal_scores["precision"](detected_predicted_abnormal_regions, detected_region_is_abnormal)
-    region_abnormal_scores["recall"](detected_predicted_abnormal_regions, detected_region_is_abnormal)
-    region_abnormal_scores["f1"](detected_predicted_abnormal_regions, detected_region_is_abnormal)
+    update_binary_classifier_counts(region_abnormal_scores, predicted_abnormal_regions, region_is_abnormal, mask=class_detected)
 
 
 def update_region_selection_metrics(region_selection_scores, selected_regions, region_has_sentence, region_is_abnormal):
     """
     Args:
-        region_selection_scores (Dict[str, Dict])
+        region_selection_scores (Dict[str, Tensor]): holds the tp, fp, tn, fn counts for each subset
         selected_regions (Tensor[bool]): shape [batch_size x 29]
         region_has_sentence (Tensor[bool]): shape [batch_size x 29]
         region_is_abnormal (Tensor[bool]): shape [batch_size x 29]
     """
-    normal_selected_regions = selected_regions[~region_is_abnormal]
-    normal_region_has_sentence = region_has_sentence[~region_is_abnormal]
+    update_binary_classifier_counts(region_selection_scores["all"], selected_regions, region_has_sentence)
+    update_binary_classifier_counts(region_selection_scores["normal"], selected_regions, region_has_sentence, mask=~region_is_abnormal)
+    update_binary_classifier_counts(region_selection_scores["abnormal"], selected_regions, region_has_sentence, mask=region_is_abnormal)
 
-    abnormal_selected_regions = selected_regions[region_is_abnormal]
-    abnormal_region_has_sentence = region_has_sentence[region_is_abnormal]
 
-    region_selection_scores["all"]["precision"](selected_regions.reshape(-1), region_has_sentence.reshape(-1))
-    region_selection_scores["all"]["recall"](selected_regions.reshape(-1), region_has_sentence.reshape(-1))
-    region_selection_scores["all"]["f1"](selected_regions.reshape(-1), region_has_sentence.reshape(-1))
+def update_object_detector_metrics(obj_detector_scores, detections, gt_boxes, class_detected):
+    """
+    Args:
+        obj_detector_scores (Dict)
+        detections (Dict): with key "top_region_boxes" that maps to a tensor of shape [batch_size x 29 x 4]
+        gt_boxes (Tensor): shape [batch_size x 29 x 4], the stacked gt boxes of image_targets (stacked once per batch by the caller)
+        class_detected (Tensor[bool]): shape [batch_size x 29]
+    """
+    def compute_intersection_and_union_area_per_region(detections, gt_boxes, class_detected):
+        # pred_boxes is of shape [batch_size x 29 x 4] and contains the predicted region boxes with the highest score (i.e. top-1)
+        # they are sorted in the 2nd dimension, meaning the 1st of the 29 boxes corresponds to the 1st region/class,
+        # the 2nd to the 2nd class and so on
+        # (the boxes can be in a lower precision if they were computed under autocast, but the areas are accumulated in float32)
+        pred_boxes = detections["top_region_boxes"].float()
 
-    region_selection_scores["normal"]["precision"](normal_selected_regions, normal_region_has_sentence)
-    region_selection_scores["normal"]["recall"](normal_selected_regions, normal_region_has_sentence)
-    region_selection_scores["normal"]["f1"](normal_selected_regions, normal_region_has_sentence)
+        # width and height of the intersection boxes, of shape [batch_size x 29 x 2]
+        # (the boxes are in [x0, y0, x1, y1] format, so the intersection box goes from the max of the (x0, y0) to the min of the (x1, y1) corners)
+        # if x0_max >= x1_min or y0_max >= y1_min, then there is no intersection, hence the clamp to 0
+        intersection_wh = (torch.minimum(pred_boxes[..., 2:], gt_boxes[..., 2:]) - torch.maximum(pred_boxes[..., :2], gt_boxes[..., :2])).clamp_(min=0)
 
-    region_selection_scores["abnormal"]["precision"](abnormal_selected_regions, abnormal_region_has_sentence)
-    region_selection_scores["abnormal"]["recall"](abnormal_selected_regions, abnormal_region_has_sentence)
-    region_selection_scores["abnormal"]["f1"](abnormal_selected_regions, abnormal_region_has_sentence)
+        # below tensors are of shape [batch_size x 29]
+        # also there is no intersection if the class was not detected by object detector
+        intersection_area = intersection_wh[..., 0] * intersection_wh[..., 1] * class_detected
+        pred_area = (pred_boxes[..., 2:] - pred_boxes[..., :2]).prod(dim=-1)
+        gt_area = (gt_boxes[..., 2:] - gt_boxes[..., :2]).prod(dim=-1)
 
+        union_area = (pred_area + gt_area) - intersection_area
 
-def update_object_detector_metrics(obj_detector_scores, detections, image_targets, class_detected):
-    def compute_box_area(box):
-        """
-        Calculate the area of a box given the 4 corner values.
+        # sum up the values along the batch dimension (the values will divided by each other later to get the averages)
+        intersection_area = torch.sum(intersection_area, dim=0)
+        union_area = torch.sum(union_area, dim=0)
 
-        Args:
-            box (Tensor[batch_size x 29 x 4])
+        return intersection_area, union_area
 
-        Returns:
-            area (Tensor[batch_size x 29])
-        """
-        x0 = box[..., 0]
-        y0 = box[..., 1]
-        x1 = box[..., 2]
-        y1 = box[..., 3]
+    # sum up detections for each region
+    region_detected_batch = torch.sum(class_detected, dim=0)
 
-        return (x1 - x0) * (y1 - y0)
+    intersection_area_per_region_batch, union_area_per_region_batch = compute_intersection_and_union_area_per_region(detections, gt_boxes, class_detected)
 
-    def compute_intersection_and_union_area_per_region(detections, targets, class_detected):
-        # pred_boxes is of shape [batch_size x 29 x 4] and contains the predicted region boxes with the highest score (i.e. top-1)
-        # they are sorted in the 2nd dimension, meaning the 1st of the 29 boxes corresponds to the 1st region/class,
-        # the 2nd to the 2nd class and so on
-        pred_boxes = detections["top_region_boxes"]
+    # the sums stay on the device and are updated in-place (they are only transferred to the cpu once after the val loop)
+    obj_detector_scores["sum_region_detected"].add_(region_detected_batch)
+    obj_detector_scores["sum_intersection_area_per_region"].add_(intersection_area_per_region_batch)
+    obj_detector_scores["sum_union_area_per_region"].add_(union_area_per_region_batch)
 
-        # targets is a list of dicts, with each dict containing the key "boxes" that contain the gt boxes of a single image
-        # gt_boxes is of shape [batch_size x 29 x 4]
-        gt_boxes = torch.stack([t["boxes"] for t in targets], dim=0)
 
-        # below tensors are of shape [batch_size x 29]
-        x0_max = torch.maximum(pred_boxes[..., 0], gt_boxes[..., 0])
-        y0_max = torch.maximum(pred_boxes[..., 1], gt_boxes[..., 1])
-        x1_min = torch.minimum(pred_boxes[..., 2], gt_boxes[..., 2])
-        y1_min = torch.minimum(pred_boxes[..., 3], gt_boxes[..., 3])
+def all_reduce_val_losses_and_scores(sum_val_losses, obj_detector_scores, region_selection_scores, region_abnormal_scores, steps_taken, num_images):
+    """
+    Sums up the (not yet normalized) val losses, object detector scores and binary classifier counts of all ranks,
+    for the case that every rank evaluated a different shard of val_dl (e.g. by using a DistributedSampler).
 
-        # intersection_boxes is of shape [batch_size x 29 x 4]
-        intersection_boxes = torch.stack([x0_max, y0_max, x1_min, y1_min], dim=-1)
+    The tensors and dicts are updated in-place, the summed up steps_taken and num_images are returned.
+    """
+    binary_classifier_counts = [region_selection_scores[subset] for subset in region_selection_scores] + [region_abnormal_scores]
 
-        # below tensors are of shape [batch_size x 29]
-        intersection_area = compute_box_area(intersection_boxes)
-        pred_area = compute_box_area(pred_boxes)
-        gt_area = compute_box_area(gt_boxes)
+    # put the val losses, steps_taken and num_images into a single tensor, such that they can be summed up with a single all_reduce call
+    # (float64 represents the integer counts exactly)
+    scalars = torch.cat([sum_val_losses.double(), torch.tensor([steps_taken, num_images], dtype=torch.float64, device=device)])
+    dist.all_reduce(scalars, op=dist.ReduceOp.SUM)
 
-        # if x0_max >= x1_min or y0_max >= y1_min, then there is no intersection
-        valid_intersection = torch.logical_and(x0_max < x1_min, y0_max < y1_min)
+    sum_val_losses.copy_(scalars[:-2])
+    steps_taken, num_images = (int(scalar) for scalar in scalars[-2:].tolist())
 
-        # also there is no intersection if the class was not detected by object detector
-        valid_intersection = torch.logical_and(valid_intersection, class_detected)
+    # the binary classifier counts are already tensors on the device, so they are stacked for a single all_reduce call
+    all_counts = torch.stack(binary_classifier_counts)
+    dist.all_reduce(all_counts, op=dist.ReduceOp.SUM)
 
-        # set all non-valid intersection areas to 0
-        intersection_area[~valid_intersection] = 0
+    for counts, summed_counts in zip(binary_classifier_counts, all_counts):
+        counts.copy_(summed_counts)
 
-        union_area = (pred_area + gt_area) - intersection_area
+    # obj_detector_scores holds the accumulated sums of the intersection areas, union areas and detections per region
+    for score in obj_detector_scores.values():
+        dist.all_reduce(score, op=dist.ReduceOp.SUM)
 
-        # sum up the values along the batch dimension (the values will divided by each other later to get the averages)
-        intersection_area = torch.sum(intersection_area, dim=0)
-        union_area = torch.sum(union_area, dim=0)
+    return steps_taken, num_images
 
-        return intersection_area, union_area
 
-    # sum up detections for each region
-    region_detected_batch = torch.sum(class_detected, dim=0)
+def move_batch_to_device(batch):
+    """
+    Copies the tensors of the batch that are needed for the forward pass to the device (with non_blocking=True).
+    Returns the batch and a list of all copied tensors.
+    """
+    images = pin_for_non_blocking_copy(batch["images"], device)
+
+    # the images are copied in channels_last memory format, since the model is also converted to it (see get_model in train_full_model.py)
+    batch["images"] = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+    batch["image_targets"] = image_targets_to_device(batch, device)
+    batch["region_has_sentence"] = batch["region_has_sentence"].to(device, non_blocking=True)
+    batch["region_is_abnormal"] = batch["region_is_abnormal"].to(device, non_blocking=True)
+
+    device_tensors = [batch["images"], batch["region_has_sentence"], batch["region_is_abnormal"]]
+    device_tensors += [v for t in batch["image_targets"] for v in t.values()]
+
+    if not PRETRAIN_WITHOUT_LM_MODEL:
+        batch["input_ids"] = batch["input_ids"].to(device, non_blocking=True)
+        batch["attention_mask"] = batch["attention_mask"].to(device, non_blocking=True)
+
+        device_tensors += [batch["input_ids"], batch["attention_mask"]]
+
+    return batch, device_tensors
+
+
+def prefetch_batches_to_device(val_dl):
+    """
+    Yields the batches of val_dl with the tensors needed for the forward pass already on the device.
+
+    On cuda, the host -> device copies of the next batch are issued on a separate copy stream before the current batch is yielded,
+    such that they overlap with the forward pass of the current batch (instead of being serialized with it on the default stream).
+    """
+    if device.type != "cuda":
+        for batch in val_dl:
+            yield move_batch_to_device(batch)[0]
 
-    intersection_area_per_region_batch, union_area_per_region_batch = compute_intersection_and_union_area_per_region(detections, image_targets, class_detected)
+        return
 
-    obj_detector_scores["sum_region_detected"] += region_detected_batch
-    obj_detector_scores["sum_intersection_area_per_region"] += intersection_area_per_region_batch
-    obj_detector_scores["sum_union_area_per_region"] += union_area_per_region_batch
+    copy_stream = torch.cuda.Stream()
+
+    def copy_batch_on_copy_stream(batch):
+        with torch.cuda.stream(copy_stream):
+            batch, device_tensors = move_batch_to_device(batch)
+            copies_done = torch.cuda.Event()
+            copies_done.record(copy_stream)
+
+        return batch, device_tensors, copies_done
+
+    def wait_for_copies(batch, device_tensors, copies_done):
+        # the compute stream only waits for the copies of this batch (and not for the ones of the next batch)
+        torch.cuda.current_stream().wait_event(copies_done)
+
+        # the tensors were allocated on the copy stream, so the caching allocator has to know that they are used on the compute stream
+        # (otherwise their memory could be reused too early)
+        for tensor in device_tensors:
+            tensor.record_stream(torch.cuda.current_stream())
+
+        return batch
+
+    prefetched_batch = None
+
+    for batch in val_dl:
+        next_prefetched_batch = copy_batch_on_copy_stream(batch)
+
+        if prefetched_batch is not None:
+            yield wait_for_copies(*prefetched_batch)
+
+        prefetched_batch = next_prefetched_batch
+
+    if prefetched_batch is not None:
+        yield wait_for_copies(*prefetched_batch)
 
 
 def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_dl, log_file, epoch):
@@ -346,19 +526,14 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
     """
     region_selection_scores = {}
     for subset in ["all", "normal", "abnormal"]:
-        region_selection_scores[subset] = {
-            # specifying average=None computes the metric for each class (i.e. negative and positive) separately
-            # we then report the score of the positive class by indexing [1] once we've computed the final scores
-            # this is equivalent to using average="binary" in sklearn.metric (with pos_label=1)
-            #
-            # note: using average="micro" is not correct, since it considers the negative and positive classes
-            # to be separate classes (even in the binary case). If e.g. pred = True and ground-truth = False,
-            # then it will be considered a FP for the positive class, but also a FN for the negative class,
-            # which does not make any sense for the binary case and leads to incorrect scores
-            "precision": torchmetrics.Precision(num_classes=2, average=None).to(device),
-            "recall": torchmetrics.Recall(num_classes=2, average=None).to(device),
-            "f1": torchmetrics.F1Score(num_classes=2, average=None).to(device),
-        }
+        # we accumulate the TP, FP, TN, FN counts over all batches and compute the precision, recall and f1
+        # of the positive class from them at the end (equivalent to average="binary" in sklearn.metric with pos_label=1)
+        #
+        # note: a "micro" average over both classes is not correct, since it considers the negative and positive classes
+        # to be separate classes (even in the binary case). If e.g. pred = True and ground-truth = False,
+        # then it will be considered a FP for the positive class, but also a FN for the negative class,
+        # which does not make any sense for the binary case and leads to incorrect scores
+        region_selection_scores[subset] = get_binary_classifier_counts()
 
     """
     For the binary classifier for region normal/abnormal detection, we want to compute the precision, recall and f1 for:
@@ -370,14 +545,11 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
       TN: region is normal (gt), and is predicted as normal by classifier (pred)
       FN: region is abnormal (gt), but is predicted as normal by classifier (pred)
     """
-    region_abnormal_scores = {
-        # specifying average=None computes the metric for each class (i.e. negative and positive) separately
-        # we then report the score of the positive class by indexing [1] once we've computed the final scores
-        # this is equivalent to using average="binary" in sklearn.metric (with pos_label=1)
-        "precision": torchmetrics.Precision(num_classes=2, average=None).to(device),
-        "recall": torchmetrics.Recall(num_classes=2, average=None).to(device),
-        "f1": torchmetrics.F1Score(num_classes=2, average=None).to(device),
-    }
+    region_abnormal_scores = get_binary_classifier_counts()
+
+    # the val losses (in the same order as in val_losses_dict) are summed up on the device,
+    # such that there is no gpu -> cpu sync (i.e. .item() call) for every loss in every batch
+    sum_val_losses = torch.zeros(len(val_losses_dict), device=device)
 
     # to recover from out of memory error if a batch has a sequence that is too long
     oom = False
@@ -387,8 +559,9 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
     # for normalizing the val losses
     steps_taken = 0
 
-    with torch.no_grad():
-        for num_batch, batch in tqdm(enumerate(val_dl)):
+    with torch.inference_mode():
+        # the tensors of the batches are already on the device (see prefetch_batches_to_device)
+        for num_batch, batch in tqdm(enumerate(prefetch_batches_to_device(val_dl)), total=len(val_dl)):
             images = batch["images"]
             image_targets = batch["image_targets"]
             region_has_sentence = batch["region_has_sentence"]
@@ -397,23 +570,15 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
             batch_size = images.size(0)
             num_images += batch_size
 
-            images = images.to(device, non_blocking=True)
-            image_targets = [{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in image_targets]
-            region_has_sentence = region_has_sentence.to(device, non_blocking=True)
-            region_is_abnormal = region_is_abnormal.to(device, non_blocking=True)
-
             if not PRETRAIN_WITHOUT_LM_MODEL:
                 input_ids = batch["input_ids"]
                 attention_mask = batch["attention_mask"]
-
-                input_ids = input_ids.to(device, non_blocking=True)
-                attention_mask = attention_mask.to(device, non_blocking=True)
             else:
                 input_ids = None
                 attention_mask = None
 
             try:
-                with torch.autocast(device_type='cuda', dtype=torch.float16):
+                with torch.autocast(device_type='cuda', dtype=eval_autocast_dtype):
                     output = model(images, image_targets, input_ids, attention_mask, region_has_sentence, region_is_abnormal)
             except RuntimeError as e:  # out of memory error
                 if "out of memory" in str(e):
@@ -472,7 +637,7 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
             # "top_scores" maps to a tensor of shape [batch_size x 29]
 
             # sum up all 4 losses from the object detector
-            obj_detector_losses = sum(loss for loss in obj_detector_loss_dict.values())
+            obj_detector_losses = sum_losses(obj_detector_loss_dict)
 
             # sum up the rest of the losses
             total_loss = WEIGHT_OBJECT_DETECTOR_LOSS * obj_detector_losses + WEIGHT_BINARY_CLASSIFIER_REGION_SELECTION_LOSS * classifier_loss_region_selection + WEIGHT_BINARY_CLASSIFIER_REGION_ABNORMAL_LOSS * classifier_loss_region_abnormal
@@ -490,14 +655,16 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
             if not PRETRAIN_WITHOUT_LM_MODEL:
                 list_of_losses.append(language_model_loss)
 
-            # dicts are insertion ordered since Python 3.7
-            for loss_type, loss in zip(val_losses_dict, list_of_losses):
-                val_losses_dict[loss_type] += loss.item() * batch_size
+            # the losses can have different dtypes under autocast, hence the cast to float32 before stacking
+            sum_val_losses.add_(torch.stack([loss.float() for loss in list_of_losses]) * batch_size)
 
             steps_taken += 1
 
             # update scores for object detector metrics
-            update_object_detector_metrics(obj_detector_scores, detections, image_targets, class_detected)
+            # image_targets is a list of dicts, with each dict containing the key "boxes" that contain the gt boxes of a single image
+            # gt_boxes is of shape [batch_size x 29 x 4]
+            gt_boxes = torch.stack([t["boxes"] for t in image_targets], dim=0)
+            update_object_detector_metrics(obj_detector_scores, detections, gt_boxes, class_detected)
 
             # update scores for region selection metrics
             update_region_selection_metrics(region_selection_scores, selected_regions, region_has_sentence, region_is_abnormal)
@@ -505,33 +672,46 @@ def get_val_losses_and_evaluate_obj_detector_and_binary_classifiers(model, val_d
             # update scores for region abnormal detection metrics
             update_region_abnormal_metrics(region_abnormal_scores, predicted_abnormal_regions, region_is_abnormal, class_detected)
 
-    # normalize the val losses by steps_taken
-    for loss_type in val_losses_dict:
-        val_losses_dict[loss_type] /= steps_taken
+    if is_dist_initialized():
+        steps_taken, num_images = all_reduce_val_losses_and_scores(
+            sum_val_losses, obj_detector_scores, region_selection_scores, region_abnormal_scores, steps_taken, num_images
+        )
+
+    # normalize the val losses by steps_taken (and transfer them to the cpu all at once)
+    # dicts are insertion ordered since Python 3.7
+    for loss_type, val_loss in zip(val_losses_dict, (sum_val_losses / steps_taken).tolist()):
+        val_losses_dict[loss_type] = val_loss
+
+    # compute object detector scores (on the cpu, after transferring the sums of all regions with a single copy)
+    sum_intersection, sum_union, sum_region_detected = torch.stack([
+        obj_detector_scores["sum_intersection_area_per_region"],
+        obj_detector_scores["sum_union_area_per_region"],
+        obj_detector_scores["sum_region_detected"],
+    ]).cpu()
 
-    # compute object detector scores
-    sum_intersection = obj_detector_scores["sum_intersection_area_per_region"]
-    sum_union = obj_detector_scores["sum_union_area_per_region"]
     obj_detector_scores["avg_iou"] = (torch.sum(sum_intersection) / torch.sum(sum_union)).item()
     obj_detector_scores["avg_iou_per_region"] = (sum_intersection / sum_union).tolist()
 
-    sum_region_detected = obj_detector_scores["sum_region_detected"]
     obj_detector_scores["avg_num_detected_regions_per_image"] = torch.sum(sum_region_detected / num_images).item()
     obj_detector_scores["avg_detections_per_region"] = (sum_region_detected / num_images).tolist()
 
-    # compute the "micro" average scores for region_selection_scores
+    # compute the precision, recall and f1 (of the positive class) for region_selection_scores
     for subset in region_selection_scores:
-        for metric, score in region_selection_scores[subset].items():
-            region_selection_scores[subset][metric] = score.compute()[1].item()  # only report results for the positive class (hence [1])
+        region_selection_scores[subset] = compute_binary_classifier_scores(region_selection_scores[subset])
 
-    # compute the "micro" average scores for region_abnormal_scores
-    for metric, score in region_abnormal_scores.items():
-        region_abnormal_scores[metric] = score.compute()[1].item()
+    # compute the precision, recall and f1 (of the positive class) for region_abnormal_scores
+    region_abnormal_scores = compute_binary_classifier_scores(region_abnormal_scores)
 
     return val_losses_dict, obj_detector_scores, region_selection_scores, region_abnormal_scores
 
 
 def evaluate_model(model, train_losses_dict, val_dl, lr_scheduler, optimizer, scaler, writer, tokenizer, run_params, generated_sentences_and_reports_folder_path):
+    """
+    The evaluation can also be run on multiple gpus (with torch.distributed initialized and val_dl using a DistributedSampler, preferably with shuffle=False).
+    Note that train_full_model.py does not set this up (i.e. it neither calls init_process_group nor uses a DistributedSampler).
+    In that case, the val losses and scores are summed up over all ranks, such that every rank steps the lr_scheduler with the same total val loss,
+    but only the main process (rank 0) writes to tensorboard and saves checkpoints.
+    """
     model.eval()
 
     epoch = run_params["epoch"]
@@ -559,17 +739,19 @@ def evaluate_model(model, train_losses_dict, val_dl, lr_scheduler, optimizer, sc
 
     current_lr = float(optimizer.param_groups[0]["lr"])
 
-    write_all_losses_and_scores_to_tensorboard(
-        writer,
-        overall_steps_taken,
-        train_losses_dict,
-        val_losses_dict,
-        obj_detector_scores,
-        region_selection_scores,
-        region_abnormal_scores,
-        language_model_scores,
-        current_lr
-    )
+    # the writes are executed in the background by the worker thread of tensorboard_queue (see AsyncWriter)
+    if is_main_process():
+        write_all_losses_and_scores_to_tensorboard(
+            AsyncWriter(writer),
+            overall_steps_taken,
+            train_losses_dict,
+            val_losses_dict,
+            obj_detector_scores,
+            region_selection_scores,
+            region_abnormal_scores,
+            language_model_scores,
+            current_lr
+        )
 
     total_val_loss = val_losses_dict["total_loss"]
 
@@ -581,15 +763,22 @@ def evaluate_model(model, train_losses_dict, val_dl, lr_scheduler, optimizer, sc
         run_params["lowest_val_loss"] = total_val_loss
         run_params["best_epoch"] = epoch
 
-        save_path = os.path.join(run_params["checkpoints_folder_path"], f"checkpoint_val_loss_{total_val_loss:.3f}_overall_steps_{overall_steps_taken}.pt")
+        # only the main process saves checkpoints
+        if is_main_process():
+            save_path = os.path.join(run_params["checkpoints_folder_path"], f"checkpoint_val_loss_{total_val_loss:.3f}_overall_steps_{overall_steps_taken}.pt")
+
+            checkpoint = {
+                # the unwrapped model is saved (i.e. without the "module." prefix of a DistributedDataParallel wrapper),
+                # such that the checkpoint can be loaded into an unwrapped model (as in train_full_model.py)
+                "model": getattr(model, "module", model).state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
+                "current_epoch": epoch,
+                "overall_steps_taken": overall_steps_taken,
+                "lowest_val_loss": total_val_loss,
+            }
 
-        checkpoint = {
-            "model": model.state_dict(),
-            "optimizer": optimizer.state_dict(),
-            "scaler": scaler.state_dict(),
-            "current_epoch": epoch,
-            "overall_steps_taken": overall_steps_taken,
-            "lowest_val_loss": total_val_loss,
-        }
+            torch.save(checkpoint, save_path)
 
-        torch.save(checkpoint, save_path)
+    # wait until all scores were written to tensorboard (re-raises the error if a write failed)
+    tensorboard_queue.join()
@@ -12,15 +12,15 @@ import pandas as pd
 import spacy
 import torch
 from torch.utils.data import DataLoader
-import torchmetrics
 from tqdm import tqdm
 import pickle
-import evaluate
 
 from src.dataset.constants import ANATOMICAL_REGIONS
-from src.full_model.custom_collator import CustomCollator
+from src.full_model.custom_collator import CustomCollator, image_targets_to_device
 from src.full_model.custom_dataset import CustomDataset
 from src.full_model.evaluate_full_model.evaluate_model import (
+    compute_binary_classifier_scores,
+    get_binary_classifier_counts,
     update_object_detector_metrics,
     update_region_abnormal_metrics,
     update_region_selection_metrics,
@@ -28,6 +28,7 @@ from src.full_model.evaluate_full_model.evaluate_model import (
 from src.full_model.evaluate_full_model.evaluate_language_model import (
     get_ref_sentences_for_selected_regions,
     get_sents_for_normal_abnormal_selected_regions,
+    get_bert_scorer,
     get_generated_reports,
     update_gen_and_ref_sentences_for_regions,
     update_num_generated_sentences_per_image,
@@ -41,6 +42,7 @@ from src.path_datasets_and_weights import (
     path_runs_full_model,
     path_test_set_evaluation_scores_txt_files,
 )
+from src.utils import eval_autocast_dtype
 
 # specify the checkpoint you want to evaluate by setting "RUN" and "CHECKPOINT"
 RUN = 2
@@ -330,7 +332,7 @@ def evaluate_language_model_on_test_set(model, test_loader, test_2_loader, token
 
         # used in function get_generated_reports
         sentence_tokenizer = spacy.load("en_core_web_trf")
-        bert_score = evaluate.load("bertscore")
+        bert_scorer = get_bert_scorer()
 
         with torch.no_grad():
             for num_batch, batch in tqdm(enumerate(test_loader), total=len(test_loader)):
@@ -347,7 +349,7 @@ def evaluate_language_model_on_test_set(model, test_loader, test_2_loader, token
                 reference_reports = batch["reference_reports"]
 
                 try:
-                    with torch.autocast(device_type="cuda", dtype=torch.float16):
+                    with torch.autocast(device_type="cuda", dtype=eval_autocast_dtype):
                         if num_batch <= 5:
                             torch.cuda.reset_peak_memory_stats(device=None)
                             pre_inference_peak = torch.cuda.max_memory_allocated(device=None)
@@ -437,7 +439,7 @@ def evaluate_language_model_on_test_set(model, test_loader, test_2_loader, token
                         selected_regions,
                         sentence_tokenizer,
                         BERTSCORE_SIMILARITY_THRESHOLD,
-                        bert_score
+                        bert_scorer
                     )
                 )
 
@@ -732,7 +734,6 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
         with torch.no_grad():
             for num_batch, batch in tqdm(enumerate(test_loader), total=len(test_loader)):
                 images = batch["images"]
-                image_targets = batch["image_targets"]
                 region_has_sentence = batch["region_has_sentence"]
                 region_is_abnormal = batch["region_is_abnormal"]
                 input_ids = None  # not needed, since here we evaluate everything except language model
@@ -742,15 +743,12 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
                 num_images += batch_size
 
                 images = images.to(device, non_blocking=True)
-                image_targets = [
-                    {k: v.to(device, non_blocking=True) for k, v in t.items()}
-                    for t in image_targets
-                ]
+                image_targets = image_targets_to_device(batch, device)
                 region_has_sentence = region_has_sentence.to(device, non_blocking=True)
                 region_is_abnormal = region_is_abnormal.to(device, non_blocking=True)
 
                 try:
-                    with torch.autocast(device_type="cuda", dtype=torch.float16):
+                    with torch.autocast(device_type="cuda", dtype=eval_autocast_dtype):
                         output = model(
                             images,
                             image_targets,
@@ -796,8 +794,10 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
                         obj_detector_scores, detections, image_targets, class_detected
                     )
                 else:
+                    # gt_boxes is of shape [batch_size x 29 x 4]
+                    gt_boxes = torch.stack([t["boxes"] for t in image_targets], dim=0)
                     update_object_detector_metrics(
-                        obj_detector_scores, detections, image_targets, class_detected
+                        obj_detector_scores, detections, gt_boxes, class_detected
                     )
 
                 # update scores for region selection metrics
@@ -858,11 +858,7 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
     """
     region_selection_scores = {}
     for subset in ["all", "normal", "abnormal"]:
-        region_selection_scores[subset] = {
-            "precision": torchmetrics.Precision(num_classes=2, average=None).to(device),
-            "recall": torchmetrics.Recall(num_classes=2, average=None).to(device),
-            "f1": torchmetrics.F1Score(num_classes=2, average=None).to(device),
-        }
+        region_selection_scores[subset] = get_binary_classifier_counts()
 
     """
     For the binary classifier for region normal/abnormal detection, we want to compute the precision, recall and f1 for:
@@ -874,11 +870,7 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
       TN: region is normal (gt), and is predicted as normal by classifier (pred)
       FN: region is abnormal (gt), but is predicted as normal by classifier (pred)
     """
-    region_abnormal_scores = {
-        "precision": torchmetrics.Precision(num_classes=2, average=None).to(device),
-        "recall": torchmetrics.Recall(num_classes=2, average=None).to(device),
-        "f1": torchmetrics.F1Score(num_classes=2, average=None).to(device),
-    }
+    region_abnormal_scores = get_binary_classifier_counts()
 
     num_images = 0
 
@@ -918,16 +910,14 @@ def evaluate_obj_detector_and_binary_classifiers_on_test_set(
         sum_region_detected / num_images
     ).tolist()
 
-    # compute the "micro" average scores for region_selection_scores
+    # compute the precision, recall and f1 (of the positive class) for region_selection_scores
     for subset in region_selection_scores:
-        for metric, score in region_selection_scores[subset].items():
-            region_selection_scores[subset][metric] = score.compute()[
-                1
-            ].item()  # only report results for the positive class (hence [1])
-
-    # compute the "micro" average scores for region_abnormal_scores
-    for metric, score in region_abnormal_scores.items():
-        region_abnormal_scores[metric] = score.compute()[1].item()
+        region_selection_scores[subset] = compute_binary_classifier_scores(
+            region_selection_scores[subset]
+        )
+
+    # compute the precision, recall and f1 (of the positive class) for region_abnormal_scores
+    region_abnormal_scores = compute_binary_classifier_scores(region_abnormal_scores)
 
     # with open('obj_detector_scores.pkl', 'rb') as f:
     #     obj_detector_scores = pickle.load(f)
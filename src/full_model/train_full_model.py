@@ -17,7 +17,7 @@ from torch.utils.data import DataLoader
 from transformers import GPT2Tokenizer
 from tqdm import tqdm
 
-from src.full_model.custom_collator import CustomCollator
+from src.full_model.custom_collator import CustomCollator, image_targets_to_device
 from src.full_model.custom_dataset import CustomDataset
 from src.full_model.evaluate_full_model.evaluate_model import evaluate_model
 from src.full_model.report_generation_model import ReportGenerationModel
@@ -52,6 +52,7 @@ from src.full_model.run_configurations import (
     WEIGHT_LANGUAGE_MODEL_LOSS,
 )
 from src.path_datasets_and_weights import path_full_dataset, path_runs_full_model
+from src.utils import sum_losses
 
 device = torch.device(
     "cuda"
@@ -157,17 +158,13 @@ def train_model(
 
         for num_batch, batch in tqdm(enumerate(train_dl)):
             images = batch["images"]
-            image_targets = batch["image_targets"]
             region_has_sentence = batch["region_has_sentence"]
             region_is_abnormal = batch["region_is_abnormal"]
 
             batch_size = images.size(0)
 
-            images = images.to(device, non_blocking=True)
-            image_targets = [
-                {k: v.to(device, non_blocking=True) for k, v in t.items()}
-                for t in image_targets
-            ]
+            images = images.to(device, non_blocking=True, memory_format=torch.channels_last)
+            image_targets = image_targets_to_device(batch, device)
             region_has_sentence = region_has_sentence.to(device, non_blocking=True)
             region_is_abnormal = region_is_abnormal.to(device, non_blocking=True)
 
@@ -220,9 +217,7 @@ def train_model(
                         ) = output
 
                     # sum up all 4 losses from the object detector
-                    obj_detector_losses = sum(
-                        loss for loss in obj_detector_loss_dict.values()
-                    )
+                    obj_detector_losses = sum_losses(obj_detector_loss_dict)
 
                     # sum up the rest of the losses
                     total_loss = (
@@ -329,6 +324,10 @@ def get_model(checkpoint=None):
     model = ReportGenerationModel(pretrain_without_lm_model=PRETRAIN_WITHOUT_LM_MODEL)
     model.to(device, non_blocking=True)
 
+    # convert the (4D) conv weights of the model to channels_last memory format (the images are converted to it as well),
+    # such that cudnn can use its faster NHWC convolution kernels under autocast
+    model.to(memory_format=torch.channels_last)
+
     if checkpoint:
         model.load_state_dict(checkpoint["model"])
     model.train()
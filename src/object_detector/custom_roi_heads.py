@@ -3,9 +3,8 @@ from typing import Optional, List, Dict, Tuple
 import torch
 import torch.nn as nn
 from torch import Tensor
-import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 from torchvision.models.detection.roi_heads import RoIHeads, fastrcnn_loss
-from torchvision.ops import boxes as box_ops
 
 
 class CustomRoIHeads(RoIHeads):
@@ -60,12 +59,28 @@ class CustomRoIHeads(RoIHeads):
         self.avg_pool = nn.AvgPool2d(kernel_size=feature_map_output_size)
         self.dim_reduction = nn.Linear(2048, 1024)
 
+        # cache of the arange tensor per device that is needed in every forward pass (see get_arange)
+        self._arange_cache = {}
+
+    def get_arange(self, end, device):
+        """
+        Returns torch.arange(end) on the device as a slice of a cached arange tensor, which is only (re)created if it is shorter than end
+        (instead of allocating small tensors in every forward pass).
+        """
+        if device not in self._arange_cache or len(self._arange_cache[device]) < end:
+            # create a normal tensor even if called under torch.inference_mode, such that it can also be used in training mode later on
+            with torch.inference_mode(False):
+                self._arange_cache[device] = torch.arange(end, dtype=torch.int64, device=device)
+
+        return self._arange_cache[device][:end]
+
     def get_top_region_features_detections_class_detected(
         self,
         box_features,
         box_regression,
         class_logits,
         proposals,
+        boxes_per_image,
         image_shapes
     ):
         """
@@ -99,111 +114,113 @@ class CustomRoIHeads(RoIHeads):
         """
         # apply softmax on background class as well
         # (such that if the background class has a high score, all other classes will have a low score)
-        pred_scores = F.softmax(class_logits, -1)
-
-        # remove score of the background class
-        pred_scores = pred_scores[:, 1:]
-
-        # get number of proposals/boxes per image
-        boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
+        # but only compute the scores of the foreground classes (i.e. without the score of the background class),
+        # by normalizing the foreground logits with the logsumexp over all classes (which is the log of the softmax denominator)
+        pred_scores = torch.exp(class_logits[:, 1:] - torch.logsumexp(class_logits, dim=-1, keepdim=True))
 
         num_images = len(boxes_per_image)
+        max_boxes_per_image = max(boxes_per_image)
 
-        # split pred_scores (which is a tensor with scores for all RoIs of all images in the batch)
-        # into the tuple pred_scores_per_img (where 1 pred_score tensor has scores for all RoIs of 1 image)
-        pred_scores_per_img = torch.split(pred_scores, boxes_per_image, dim=0)
-
-        # if we train/evaluate the full model, we need the top region/box features
-        if self.return_feature_vectors:
-            # split region_features the same way as pred_scores
-            region_features_per_img = torch.split(box_features, boxes_per_image, dim=0)
-        else:
-            region_features_per_img = [None] * num_images  # dummy list such that we can still zip everything up
-
-        # if we evaluate the object detector, we need the detections
-        if not self.training:
-            pred_region_boxes = self.box_coder.decode(box_regression, proposals)
-            pred_region_boxes_per_img = torch.split(pred_region_boxes, boxes_per_image, dim=0)
-        else:
-            pred_region_boxes_per_img = [None] * num_images  # dummy list such that we can still zip everything up
-
-        output = {}
-        output["class_detected"] = []  # list collects the bool arrays of shape [29] that specify if a class was detected (True) for each image
-        output["top_region_features"] = []  # list collects the tensors of shape [29 x 2048] of the top region features for each image
-
-        # list top_region_boxes collects the tensors of shape [29 x 4] of the top region boxes for each image
-        # list top_scores collects the tensors of shape [29] of the corresponding top scores for each image
-        output["detections"] = {
-            "top_region_boxes": [],
-            "top_scores": []
-        }
-
-        for pred_scores_img, pred_region_boxes_img, region_features_img, img_shape in zip(pred_scores_per_img, pred_region_boxes_per_img, region_features_per_img, image_shapes):
-            # get the predicted class for each box (dim=1 goes by box)
-            pred_classes = torch.argmax(pred_scores_img, dim=1)
-
-            # create a mask that is 1 at the predicted class index for every box and 0 otherwise
-            mask_pred_classes = torch.nn.functional.one_hot(pred_classes, num_classes=29).to(pred_scores_img.device)
+        def split_into_images(tensor):
+            """
+            Splits a tensor with values for all RoIs of all images in the batch (in the 1st dim) into a tensor of shape [batch_size x max_boxes_per_image x ...],
+            such that all images can be processed at once (instead of in a python loop over the images).
 
-            # by multiplying the pred_scores with the mask, we set to 0.0 all scores except for the top score in each row
-            pred_top_scores_img = pred_scores_img * mask_pred_classes
+            If the images have different numbers of boxes, the tensors of the images are padded with zeros (see valid_boxes).
+            """
+            if all(num_boxes == max_boxes_per_image for num_boxes in boxes_per_image):
+                return tensor.view(num_images, max_boxes_per_image, *tensor.shape[1:])
 
-            # get the scores and row indices of the box/region features with the top-1 score for each class (dim=0 goes by class)
-            top_scores, indices_with_top_scores = torch.max(pred_top_scores_img, dim=0)
+            return pad_sequence(torch.split(tensor, boxes_per_image, dim=0), batch_first=True)
 
-            # check if all regions/classes have at least 1 box where they are the predicted class (i.e. have the highest score)
-            # this is done because we want to collect 29 region features (each with the highest score for the class) for 29 regions
-            num_predictions_per_class = torch.sum(mask_pred_classes, dim=0)
+        # valid_boxes is of shape [batch_size x max_boxes_per_image] and is False for the padded boxes (see split_into_images)
+        valid_boxes = self.get_arange(max_boxes_per_image, pred_scores.device)[None] < torch.tensor(boxes_per_image, device=pred_scores.device)[:, None]
 
-            # get a boolean array that is True for the classes that were detected
-            class_detected = (num_predictions_per_class > 0)
+        # pred_scores is of shape [batch_size x max_boxes_per_image x 29]
+        pred_scores = split_into_images(pred_scores)
 
-            output["class_detected"].append(class_detected)
+        # get the predicted class for each box (dim=2 goes by class)
+        pred_classes = torch.argmax(pred_scores, dim=2)
 
-            if self.return_feature_vectors:
-                # extract the region features with the top scores for each class
-                # note that if a class was not predicted/detected (as the class with the highest score for at least 1 box),
-                # then the argmax will have returned index 0 for that class (since all scores of the class will have been 0.0)
-                # and thus its region features will be the 1st one in the tensor region_features_img
-                # but since we have the boolean array class_detected, we can filter out this class (and its erroneous region feature) later on
-                top_region_features = region_features_img[indices_with_top_scores]
-                output["top_region_features"].append(top_region_features)
+        class_indices = self.get_arange(29, pred_scores.device)
 
-            if not self.training:
-                # pred_region_boxes_img is of shape [num_boxes_in_image x 30 x 4]
+        # create a bool mask that is True at the predicted class index for every (non-padded) box and False otherwise
+        # (comparing with class_indices directly gives a bool mask, instead of an int64 one_hot mask that has to be multiplied with the scores)
+        mask_pred_classes = (pred_classes.unsqueeze(-1) == class_indices) & valid_boxes.unsqueeze(-1)
 
-                # clip boxes so that they lie inside an image of size "img_shape"
-                pred_region_boxes_img = box_ops.clip_boxes_to_image(pred_region_boxes_img, img_shape)
+        # set all scores except for the top score in each row to -1
+        # (since all scores are >= 0, a class only gets a top score of -1 if it was not the predicted class for any box)
+        pred_top_scores = pred_scores.masked_fill(~mask_pred_classes, -1.0)
 
-                # remove predictions with the background label
-                # pred_region_boxes_img is now of shape [num_boxes_in_image x 29 x 4]
-                pred_region_boxes_img = pred_region_boxes_img[:, 1:]
+        # get the scores and row indices of the box/region features with the top-1 score for each class (dim=1 goes by box)
+        # top_scores and indices_with_top_scores are of shape [batch_size x 29]
+        top_scores, indices_with_top_scores = torch.max(pred_top_scores, dim=1)
 
-                # extract the region boxes with the top scores for each class
-                # note that if a class was not predicted/detected (as the class with the highest score for at least 1 box),
-                # then the argmax will have returned index 0 for that class (since all scores of the class will have been 0.0)
-                # and thus the region box will be the 1st one in the tensor pred_region_boxes_img
-                # but since we have the boolean array class_detected, we can filter out this class (and its erroneous region box) later on
+        output = {}
 
-                # since indices_with_top_scores is sorted from class 0 to class 28, we first use the indices to select the correct box_array (of shape [29 x 4]),
-                # and then the number in torch.arange (starting from 0 and ending at 28) will select the correct box for this class from the box_array
-                top_region_boxes = pred_region_boxes_img[indices_with_top_scores, torch.arange(start=0, end=29, dtype=torch.int64, device=indices_with_top_scores.device)]
+        # check if all regions/classes have at least 1 box where they are the predicted class (i.e. have the highest score)
+        # this is done because we want to collect 29 region features (each with the highest score for the class) for 29 regions
+        # class_detected is a boolean array of shape [batch_size x 29] that is True for the classes that were detected
+        output["class_detected"] = top_scores > -1
 
-                # note: top_region_boxes and top_scores are both ordered by class
-                # (i.e. class 0 will be the first row in top_region_boxes and the first value in top_scores,
-                # class 28 will be the last row in top_region_boxes and the last value in top_scores)
-                output["detections"]["top_region_boxes"].append(top_region_boxes)
-                output["detections"]["top_scores"].append(top_scores)
+        # classes that were not detected keep a top score of 0.0
+        top_scores = top_scores.clamp(min=0.0)
 
-        # convert lists into batched tensors
-        output["class_detected"] = torch.stack(output["class_detected"], dim=0)  # of shape [batch_size x 29]
+        def gather_top_boxes(tensor, indices):
+            """
+            Selects the rows of tensor (of shape [batch_size x num_rows x dim]) given by indices (of shape [batch_size x 29]) for each image,
+            with a single torch.gather call (instead of advanced indexing), resulting in a tensor of shape [batch_size x 29 x dim].
+            """
+            return torch.gather(tensor, 1, indices.unsqueeze(-1).expand(-1, -1, tensor.shape[-1]))
 
+        # if we train/evaluate the full model, we need the top region/box features
         if self.return_feature_vectors:
-            output["top_region_features"] = torch.stack(output["top_region_features"], dim=0)  # of shape [batch_size x 29 x 2048]
+            # extract the region features with the top scores for each class
+            # note that if a class was not predicted/detected (as the class with the highest score for at least 1 box),
+            # then the argmax will have returned index 0 for that class (since all scores of the class will have been -1)
+            # and thus its region features will be the 1st one of the image
+            # but since we have the boolean array class_detected, we can filter out this class (and its erroneous region feature) later on
+            region_features = split_into_images(box_features)
+            output["top_region_features"] = gather_top_boxes(region_features, indices_with_top_scores)  # of shape [batch_size x 29 x 2048]
 
+        # if we evaluate the object detector, we need the detections
         if not self.training:
-            output["detections"]["top_region_boxes"] = torch.stack(output["detections"]["top_region_boxes"], dim=0)  # of shape [batch_size x 29 x 4]
-            output["detections"]["top_scores"] = torch.stack(output["detections"]["top_scores"], dim=0)  # of shape [batch_size x 29]
+            # only the region boxes with the top scores for each class are decoded (instead of decoding the boxes of all 30 classes for all proposals)
+            # box_regression_per_img is of shape [batch_size x (max_boxes_per_image * 30) x 4], i.e. the 30 boxes of each proposal are consecutive rows
+            # proposals_per_img is of shape [batch_size x max_boxes_per_image x 4]
+            box_regression_per_img = split_into_images(box_regression).view(num_images, -1, 4)
+            proposals_per_img = split_into_images(torch.cat(proposals, dim=0))
+
+            # extract the regression deltas and proposals of the boxes with the top scores for each class
+            # note that if a class was not predicted/detected, the region box will be the 1st one of the image (see note above)
+            # but since we have the boolean array class_detected, we can filter out this class (and its erroneous region box) later on
+
+            # since indices_with_top_scores is sorted from class 0 to class 28, the row of the correct box for each class is the start row of the box_array
+            # of the proposal (i.e. index * 30) plus the number in class_indices + 1 (starting from 1 and ending at 29, i.e. skipping the background class)
+            top_box_regression = gather_top_boxes(box_regression_per_img, indices_with_top_scores * 30 + class_indices + 1)  # of shape [batch_size x 29 x 4]
+            top_proposals = gather_top_boxes(proposals_per_img, indices_with_top_scores)  # of shape [batch_size x 29 x 4]
+
+            # the boxes are decoded in float32, since the regression deltas can be in a lower precision under autocast
+            # (which would make the decoded box coordinates inaccurate by several pixels in bfloat16)
+            top_region_boxes = self.box_coder.decode_single(top_box_regression.reshape(-1, 4).float(), top_proposals.reshape(-1, 4).float())
+            top_region_boxes = top_region_boxes.view(num_images, 29, 4)
+
+            # clip boxes so that they lie inside an image of size "img_shape"
+            # (clipping only the top region boxes is equivalent to clipping all boxes before the extraction, since clipping is element-wise)
+            # the boxes of all images are clipped at once (instead of calling box_ops.clip_boxes_to_image in a python loop over the images),
+            # by clamping the (x1, y1, x2, y2) coordinates to (width, height, width, height) of the respective image
+            max_coordinates = torch.tensor(
+                [[width, height, width, height] for height, width in image_shapes], dtype=top_region_boxes.dtype, device=top_region_boxes.device
+            )
+            top_region_boxes = torch.minimum(top_region_boxes.clamp(min=0), max_coordinates.unsqueeze(1))
+
+            # note: top_region_boxes and top_scores are both ordered by class
+            # (i.e. class 0 will be the first row in top_region_boxes and the first value in top_scores,
+            # class 28 will be the last row in top_region_boxes and the last value in top_scores)
+            output["detections"] = {
+                "top_region_boxes": top_region_boxes,  # of shape [batch_size x 29 x 4]
+                "top_scores": top_scores,  # of shape [batch_size x 29]
+            }
 
         return output
 
@@ -228,6 +245,9 @@ class CustomRoIHeads(RoIHeads):
             labels = None
             regression_targets = None
 
+        # get number of proposals/boxes per image (computed once here, since proposals don't change anymore after select_training_samples)
+        boxes_per_image = [boxes_in_image.shape[0] for boxes_in_image in proposals]
+
         # box_roi_pool_feature_maps has shape [overall_num_proposals_for_all_images x 2048 x 8 x 8]
         box_roi_pool_feature_maps = self.box_roi_pool(features, proposals, image_shapes)
 
@@ -255,7 +275,7 @@ class CustomRoIHeads(RoIHeads):
             # remove all dims of size 1
             box_features = torch.squeeze(box_features)
 
-            output = self.get_top_region_features_detections_class_detected(box_features, box_regression, class_logits, proposals, image_shapes)
+            output = self.get_top_region_features_detections_class_detected(box_features, box_regression, class_logits, proposals, boxes_per_image, image_shapes)
 
             roi_heads_output["class_detected"] = output["class_detected"]
 
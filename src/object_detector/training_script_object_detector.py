@@ -1,8 +1,8 @@
 from ast import literal_eval
-from copy import deepcopy
 import logging
 import os
 import random
+import threading
 from typing import List, Dict
 
 import albumentations as A
@@ -23,6 +23,7 @@ from src.dataset.constants import ANATOMICAL_REGIONS
 from src.object_detector.custom_image_dataset_object_detector import CustomImageDataset
 from src.object_detector.object_detector import ObjectDetector
 from src.path_datasets_and_weights import path_full_dataset, path_runs_object_detector, small_imgs
+from src.utils import eval_autocast_dtype, sum_losses
 
 device = torch.device(
     "cuda"
@@ -265,11 +266,8 @@ def compute_intersection_and_union_area_per_class(detections, targets, class_det
     valid_intersection = torch.logical_and(valid_intersection, class_detected)
 
     # set all non-valid intersection areas to 0
-    intersection_area = torch.where(
-        valid_intersection,
-        intersection_area,
-        torch.tensor(0, dtype=intersection_area.dtype, device=intersection_area.device),
-    )
+    # (multiplying by the bool mask avoids allocating a new scalar tensor for torch.where every batch)
+    intersection_area = intersection_area * valid_intersection
 
     union_area = (pred_area + gt_area) - intersection_area
 
@@ -315,7 +313,9 @@ def get_val_loss_and_other_metrics(model, val_dl, writer, overall_steps_taken):
     # tensor for accumulating the union area of each class (will divide the intersection area of each class at the end of get the IoU for each class)
     sum_union_area_per_class = torch.zeros(29, device=device)
 
-    with torch.no_grad():
+    # inference_mode is cheaper than no_grad, since it additionally disables the view and version counter tracking of tensors
+    # (none of the tensors computed in the loop are needed for autograd later on)
+    with torch.inference_mode():
         for batch_num, batch in tqdm(enumerate(val_dl)):
             # "targets" maps to a list of dicts, where each dict has the keys "boxes" and "labels" and corresponds to a single image
             # "boxes" maps to a tensor of shape [29 x 4] and "labels" maps to a tensor of shape [29]
@@ -338,11 +338,11 @@ def get_val_loss_and_other_metrics(model, val_dl, writer, overall_steps_taken):
             # "top_scores" maps to a tensor of shape [batch_size x 29]
 
             # class_detected is a tensor of shape [batch_size x 29]
-            with torch.autocast(device_type="cuda", dtype=torch.float16):
+            with torch.autocast(device_type="cuda", dtype=eval_autocast_dtype):
                 loss_dict, detections, class_detected = model(images, targets)
 
             # sum up all 4 losses
-            loss = sum(loss for loss in loss_dict.values())
+            loss = sum_losses(loss_dict)
             val_loss += loss.item() * batch_size
 
             # sum up detections for each class
@@ -441,6 +441,16 @@ def train_model(
     # the best_model_state is the one where the val loss is the lowest overall
     best_model_state = None
 
+    # the best model weights are copied into 2 preallocated (pinned) cpu buffers in turn, such that the copy from the gpu can be non-blocking
+    # and a new best model state can be copied into one buffer while the other buffer is still being saved to disk (in save_thread)
+    best_model_state_buffers = [
+        {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=torch.cuda.is_available()) for k, v in model.state_dict().items()}
+        for _ in range(2)
+    ]
+    best_model_state_buffer_index = 0
+    save_thread = None
+    save_thread_buffer_index = None
+
     overall_steps_taken = 0  # for logging to tensorboard
 
     # for gradient accumulation
@@ -469,7 +479,7 @@ def train_model(
                 loss_dict = model(images, targets)
 
                 # sum up all 4 losses
-                loss = sum(loss for loss in loss_dict.values())
+                loss = sum_losses(loss_dict)
 
             scaler.scale(loss).backward()
 
@@ -546,7 +556,18 @@ def train_model(
                         weights_folder_path,
                         f"val_loss_{lowest_val_loss:.3f}_epoch_{epoch}.pth",
                     )
-                    best_model_state = deepcopy(model.state_dict())
+
+                    # flip to the other buffer (which does not hold the previous best model state)
+                    best_model_state_buffer_index = 1 - best_model_state_buffer_index
+
+                    # make sure that the buffer is not overwritten while it is still being saved to disk
+                    if save_thread is not None and save_thread_buffer_index == best_model_state_buffer_index:
+                        save_thread.join()
+
+                    # copy the weights directly to the cpu (instead of a deepcopy, which would clone all weights on the gpu first)
+                    best_model_state = best_model_state_buffers[best_model_state_buffer_index]
+                    for k, v in model.state_dict().items():
+                        best_model_state[k].copy_(v, non_blocking=True)
 
                 # log to console at the end of an epoch
                 if (num_batch + 1) == len(train_dl):
@@ -557,7 +578,22 @@ def train_model(
                 steps_taken = 0
 
         # save the current best model weights at the end of each epoch
-        torch.save(best_model_state, best_model_save_path)
+        # (in a separate thread, such that the next epoch does not have to wait for the weights to be written to disk)
+        if save_thread is not None:
+            save_thread.join()
+
+        # wait for the non-blocking copies of the weights to the cpu to finish before they are saved
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        save_thread = threading.Thread(target=torch.save, args=(best_model_state, best_model_save_path), daemon=True)
+        save_thread.start()
+        save_thread_buffer_index = best_model_state_buffer_index
+
+    # wait for the last best model weights to be saved
+    # (save_thread is None if the epoch loop didn't run, e.g. when resuming at the final epoch)
+    if save_thread is not None:
+        save_thread.join()
 
     log.info("Finished training!")
     log.info(f"Lowest overall val loss: {lowest_val_loss:.3f} at epoch {best_epoch}")
@@ -615,7 +651,10 @@ def get_data_loaders(train_dataset, val_dataset):
         collate_fn=collate_fn,
         batch_size=BATCH_SIZE,
         shuffle=False,
-        num_workers=0,
+        # the val loader is iterated over at every evaluation, so the workers are kept alive in between
+        # (such that the next batches are already loaded and pinned while the model is still evaluating the current batch)
+        num_workers=NUM_WORKERS,
+        persistent_workers=NUM_WORKERS > 0,
         pin_memory=True,
     )
 
@@ -18,6 +18,11 @@ when training the object detector and full model (with and without the language
 That means the directories specified by path_runs_* should already exist before starting the training.
 
 path_test_set_evaluation_scores_txt_files will be the path where the txt files will be stored which contain the test set scores.
+
+path_generation_cache (optional) specifies a directory where the outputs of model.generate during the evaluation of the language model
+are cached, such that evaluations with unchanged model weights can skip the generation (see evaluate_language_model.py).
+Set it to None to disable the cache. The cached files are never deleted automatically, and the directory has to be cleared
+whenever the model or generation code changes (since the cache keys only cover the weights, not the code).
 """
 
 base_path = "/users-2/blasko"
@@ -29,4 +34,5 @@ path_chexbert_weights = f"{base_path}/repos/rgrg/src/CheXbert/src/models/chexber
 path_runs_object_detector = f"{base_path}/repos/rgrg/runs/object_detector"
 path_runs_full_model = f"{base_path}/repos/rgrg/runs/full_model"
 path_test_set_evaluation_scores_txt_files = f"{base_path}/repos/rgrg/src"
+path_generation_cache = None
 small_imgs = True
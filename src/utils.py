@@ -0,0 +1,28 @@
+"""
+Small torch helpers that are shared by the training and evaluation scripts of the object detector and the full model.
+"""
+import torch
+
+# dtype used for autocast in the evaluation forward passes (which don't need a GradScaler, unlike the training forward passes)
+# bfloat16 has the same range as float32 (i.e. no overflows), but is only supported by recent gpus, hence the fallback to float16
+eval_autocast_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+
+
+def sum_losses(loss_dict):
+    """
+    Sums up the (scalar) losses of loss_dict.
+    Stacking and summing them up launches 1 kernel, instead of 1 add kernel per loss (as with the python sum builtin).
+    """
+    return torch.stack(list(loss_dict.values())).sum()
+
+
+def pin_for_non_blocking_copy(tensor, device):
+    """
+    Copies with non_blocking=True only overlap with gpu work if the source tensor is in pinned memory,
+    so the tensor is pinned if it is copied to a cuda device and not already pinned
+    (which it already is if the dataloader was created with pin_memory=True, as in train_full_model.py).
+    """
+    if device.type == "cuda" and not tensor.is_pinned():
+        return tensor.pin_memory()
+
+    return tensor